@@ -14,17 +14,23 @@ from fardel import core
 from fardel.ext import db, jwt, cache, login_manager, babel, mail
 
 
-__all__ = ("Fardel",)
+__all__ = ("Fardel", "PanelError")
 
 DEFAULT_APP_NAME = "fardel"
 
 
+class PanelError(Exception):
+    """ An admin panel has a url which isn't protected or misplaced """
+
+
 class Fardel(object):
     ignored_panel_urls = ["static"]
 
     def __init__(self, config_class, **flask_options):
         self.app = Flask(DEFAULT_APP_NAME, **flask_options)
         self.panels = []
+        self.panel_apps = {}
+        self.panel_report = {}
 
         self.configure_app(config_class)
         self.configure_addons()
@@ -90,6 +96,8 @@ class Fardel(object):
                     self.app.logger.warning("%s app not found" % app_name)
                     self.app.logger.warning(err, exc_info=True)
 
+        self.validate_panels()
+
     def configure_views(self):
         self.app.add_url_rule("/api/search/", "search", core.search)
 
@@ -110,6 +118,18 @@ class Fardel(object):
         if self.app.config["SENTRY_DSN"]:
             sentry = Sentry(self.app, dsn=self.app.config["SENTRY_DSN"])
 
+    def sync_permissions(self):
+        """
+        Creates the permissions of core and active apps in one transaction.
+        Call it once before workers are forked, e.g. from gunicorn's
+        ``on_starting`` hook, and set ``SYNC_PERMISSIONS_ON_FIRST_REQUEST``
+        to ``False`` so workers start hot.
+        """
+        from fardel.core.auth.models import sync_permissions
+
+        with self.app.app_context():
+            return sync_permissions()
+
     def init_jinja_globals(self):
         from fardel.core.panel.template_tags import add_globals
 
@@ -118,22 +138,40 @@ class Fardel(object):
     def _register_panel(self, app, blueprint, app_name):
         if blueprint.name.endswith("panel"):
             self.panels.append(blueprint.name)
+            self.panel_apps[blueprint.name] = app_name
             self.app.register_blueprint(blueprint)
-            for rule in self.app.url_map.iter_rules():
-                endpoint = rule.endpoint.split(".")
-                if endpoint[0] in self.panels and not rule.rule.startswith("/panel/"):
-                    raise Exception("Panel url must start with /panel/")
-                if endpoint[0] in self.panels and endpoint[1] not in self.ignored_panel_urls:
-                    view_func = self.app.view_functions.get(rule.endpoint)
-                    has_staff_required = False
-                    has_admin_required = False
-                    if hasattr(view_func, "decorators"):
-                        has_staff_required = view_func.decorators.get("staff_required", False)
-                        has_admin_required = view_func.decorators.get("admin_required", False)
-
-                    if not has_staff_required and not has_admin_required:
-                        raise Exception("No staff_required or admin_required for panel function %s" % rule.endpoint)
-
             self.app.logger.debug("Admin panel for %s registered" % app_name)
         else:
             raise Exception("Panel blueprint's name must ends with panel")
+
+    def validate_panels(self):
+        """
+        Checks the rules of every registered panel in one pass over the url
+        map, once all blueprints are registered. Fills ``panel_report`` with
+        the validated endpoints of each panel. A bad rule raises
+        :class:`PanelError` naming the app, so the site doesn't start with
+        an unprotected panel.
+        """
+        panels = set(self.panels)
+        report = {name: [] for name in self.panels}
+        for rule in self.app.url_map.iter_rules():
+            panel, _, name = rule.endpoint.partition(".")
+            if panel not in panels:
+                continue
+            app_name = self.panel_apps.get(panel, panel)
+            if not rule.rule.startswith("/panel/"):
+                raise PanelError("Panel url %s of %s must start with /panel/" % (rule.rule, app_name))
+            if name in self.ignored_panel_urls:
+                continue
+
+            view_func = self.app.view_functions.get(rule.endpoint)
+            decorators = getattr(view_func, "decorators", {})
+            if not decorators.get("staff_required") and not decorators.get("admin_required"):
+                raise PanelError("No staff_required or admin_required for panel function %s of %s" % (
+                    rule.endpoint, app_name))
+            report[panel].append(rule.endpoint)
+
+        self.panel_report = report
+        self.app.logger.info("Validated %d endpoints of %d admin panels" % (
+            sum(len(endpoints) for endpoints in report.values()), len(report)))
+        return report
@@ -21,16 +21,56 @@ class BaseConfig(object):
     JWT_REFRESH_TOKEN_EXPIRES = False
     JWT_ACCESS_TOKEN_EXPIRES = False
 
+    # Without a shared cache backend, how long other workers may still
+    # accept a token after logout
+    REVOKED_TOKEN_CACHE_TTL = 30
+    REVOKED_TOKEN_SYNC_OVERLAP = 100
+    USER_CACHE_TIMEOUT = 30
+    PERMISSION_CACHE_TIMEOUT = 300
+    AUTH_LOADER_STRATEGIES = {
+        "user_access": "selectin",
+        "user_groups": "selectin",
+        "group_permissions": "selectin",
+    }
+
+    BCRYPT_LOG_ROUNDS = 12
+    PASSWORD_HASHING_WORKERS = 2
+    PASSWORD_HASHING_QUEUE_SIZE = 32
+
     UPLOAD_FOLDER = Path(__file__).parent.parent / 'uploads'
 
     FARDEL_APP_PATH = "fardel_apps"
     ACTIVE_APPS = ()
+    SYNC_PERMISSIONS_ON_FIRST_REQUEST = True
 
     SITE_NAME = lazy_gettext("Fardel")
 
     CACHE_TYPE = 'simple'
+    MODEL_VERSION_TIMEOUT = 300
+    MODEL_VERSIONS_SHARED = None
+
+    API_MAX_BATCH_SIZE = 1000
+
+    # Outside PostgreSQL a search past SEARCH_TIMEOUT keeps its thread until
+    # the query ends, keep a thread for each slow model besides the others
+    SEARCH_WORKERS = 4
+    SEARCH_TIMEOUT = 2.0
+    SEARCH_BACKEND = "database"
+    SEARCH_INDEX_DIR = PATH_TO_ROOT / "search_index"
+    SEARCH_INDEX_COMPACT_BYTES = 8 * 1024 * 1024
+    SEARCH_FULLTEXT_CONFIG = "simple"
+    SEARCH_MAX_PER_PAGE = 50
+    SEARCH_CACHE_TIMEOUT = 60
 
     PANEL_BASE_DIR = "ltr"
+    PANEL_SIDEBAR_CACHE_SIZE = 128
+    PANEL_COUNT_CACHE_TIMEOUT = 60
+    PANEL_COUNT_EXACT_BELOW = 10000
+
+    EMAIL_INDEX_WARMUP = True
+    EMAIL_INDEX_MAX_AGE = 3600
+    EMAIL_INDEX_MAX_CHANGES = 1000
+    EMAIL_SEARCH_LIMIT = 10
     BABEL_DEFAULT_LOCALE = "en"
     BABEL_TRANSLATION_DIRECTORIES = str(PATH_TO_ROOT / "translations")
 
@@ -1,21 +1,146 @@
-from flask import request, jsonify
+import os
+import time
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from flask import request, jsonify, current_app, copy_current_request_context
+from sqlalchemy import text
+
+from fardel.ext import db
+
+from . import fulltext
+from .indexer import search_index
+from .searchcache import search_cache, normalize_query
+from .serializers import dump_query, dump_ids
 
 __all__ = ('search')
 
 models = []
 
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+# Future of the search still running for each model
+_running = {}
+
+
+def get_executor():
+    """
+    Pool running the searches of every model, at most ``SEARCH_WORKERS``
+    at once. Each search holds one pooled connection while it runs.
+    """
+    global _executor, _executor_pid
+    with _executor_lock:
+        # A forked server must not reuse the threads of its parent
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(
+                max_workers=current_app.config["SEARCH_WORKERS"],
+                thread_name_prefix="fardel-search")
+            _executor_pid = os.getpid()
+            _running.clear()
+    return _executor
+
+
+def submit(executor, model, *args):
+    """
+    Submits the search of ``model`` unless its previous search is still
+    running, then returns ``None``. So a slow model holds at most one thread
+    of the pool and can't starve the searches of other models.
+    """
+    with _executor_lock:
+        future = _running.get(model)
+        if future is not None and not future.done():
+            return None
+        # Each thread gets its own copy of the request and app contexts, so
+        # it uses its own session which is removed when the search ends
+        run = copy_current_request_context(search_model)
+        future = _running[model] = executor.submit(run, model, *args)
+    return future
+
+
+def search_model(model, search_string, page, per_page, deadline):
+    backend = current_app.config["SEARCH_BACKEND"]
+    if not getattr(model, "search_fields", None):
+        backend = "database"
+    if backend == "index":
+        return dump_ids(model, search_index.search_ids(model, search_string, page, per_page))
+
+    try:
+        if db.engine.dialect.name == "postgresql":
+            # Stop the query on the server too once the deadline has passed
+            remaining = max(int((deadline - time.monotonic()) * 1000), 1)
+            db.session.execute(text("SET LOCAL statement_timeout = %d" % remaining))
+        if backend == "fulltext":
+            return dump_query(model, fulltext.page_query(model, search_string, page, per_page))
+        return [obj.dict() for obj in model.query.search(search_string).paginate(
+            page=page, per_page=per_page, error_out=False
+        ).items]
+    finally:
+        db.session.rollback()
+
+
+def result_key(model):
+    return "%ss" % model.__name__.lower()
+
 
 def search():
-    search_string = request.args.get('q')
+    """
+    Searches every registered model concurrently. Models declaring
+    ``search_fields`` are searched with the built-in index when
+    ``SEARCH_BACKEND`` is ``"index"``, or with PostgreSQL full-text search
+    when it's ``"fulltext"``, others with ``model.query.search``. Models which
+    haven't answered within ``SEARCH_TIMEOUT`` seconds are left out of the
+    response and listed in ``timed_out``, models whose search failed in
+    ``failed``. Results are cached per model until its rows change, see
+    :class:`~fardel.core.searchcache.SearchCache`.
+
+    The deadline only stops waiting. On PostgreSQL the query is cancelled by
+    ``statement_timeout`` too, on other databases it keeps its thread until
+    it ends. Meanwhile the model isn't searched again and is listed in
+    ``timed_out`` right away.
+    """
+    search_string = normalize_query(request.args.get('q', ''))
     if not search_string:
         return jsonify({"message": "Search string must be provided"}), 422
 
-    page = request.args.get('page', 1, type=int)
+    page = max(request.args.get('page', 1, type=int), 1)
     per_page = request.args.get('per_page', 8, type=int)
-    response = {}
+    per_page = min(max(per_page, 1), current_app.config["SEARCH_MAX_PER_PAGE"])
+    deadline = time.monotonic() + current_app.config["SEARCH_TIMEOUT"]
+
+    keys = search_cache.keys(models, search_string, page, per_page)
+    results = search_cache.get_many(keys)
+
+    executor = get_executor()
+    futures = {}
+    busy = []
     for model in models:
-        key = "%ss" % model.__name__.lower()
-        response[key] = [obj.dict() for obj in model.query.search(search_string).paginate(
-            page=page, per_page=per_page, error_out=False
-        ).items]
+        if model in results:
+            continue
+        future = submit(executor, model, search_string, page, per_page, deadline)
+        if future is None:
+            busy.append(model)
+        else:
+            futures[future] = model
+
+    done, not_done = wait(futures, timeout=max(deadline - time.monotonic(), 0))
+    for future in not_done:
+        future.cancel()
+    searched = {}
+    failed = []
+    for future in done:
+        model = futures[future]
+        try:
+            searched[model] = future.result()
+        except Exception as err:
+            current_app.logger.exception("Search in %s failed: %s" % (model.__name__, err))
+            failed.append(model)
+    search_cache.set_many(keys, searched)
+    results.update(searched)
+
+    response = {result_key(model): result for model, result in results.items()}
+    timed_out = [futures[future] for future in not_done] + busy
+    response["timed_out"] = sorted(result_key(model) for model in timed_out)
+    response["failed"] = sorted(result_key(model) for model in failed)
     return jsonify(response)
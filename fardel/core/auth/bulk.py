@@ -0,0 +1,202 @@
+"""
+Bulk creation and updates of users for data imports, load tests and the
+panel's bulk actions.
+"""
+
+import csv
+import json
+import itertools
+
+from sqlalchemy import and_, exists, literal
+from sqlalchemy.dialects import postgresql, sqlite
+
+from fardel.ext import db
+from fardel.core.versions import model_versions
+
+from .models import User, user_group_table
+from .cache import user_identities, permission_sets
+from .hashing import password_hasher
+from .email_index import email_index
+
+__all__ = [
+    "read_users_csv", "read_users_ndjson", "generate_users", "import_users",
+    "update_users", "add_users_to_group", "remove_users_from_group",
+]
+
+BOOLEAN_FIELDS = ("is_admin", "is_staff", "confirmed", "deleted")
+
+
+def read_users_csv(file):
+    for record in csv.DictReader(file):
+        yield record
+
+
+def read_users_ndjson(file):
+    for line in file:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def generate_users(count, password=None):
+    """ Yields ``count`` synthetic users which all share the same password """
+    from mimesis import Person
+
+    person = Person("en")
+    password_hash = password_hasher.hash(password) if password else None
+    for i in range(count):
+        local, domain = person.email().split("@")
+        yield {
+            "email": "%s.%d@%s" % (local, i, domain),
+            "first_name": person.name(),
+            "last_name": person.surname(),
+            "password_hash": password_hash,
+            "confirmed": True,
+        }
+
+
+def to_bool(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "y")
+    return bool(value)
+
+
+def prepare_rows(records):
+    rows = []
+    for record in records:
+        if not record.get("email"):
+            continue
+        row = {
+            "_email": record["email"].strip().lower(),
+            "first_name": record.get("first_name") or "",
+            "last_name": record.get("last_name") or "",
+            "username": record.get("username") or None,
+            "password_hash": record.get("password_hash") or None,
+        }
+        for field in BOOLEAN_FIELDS:
+            row[field] = to_bool(record.get(field, False))
+        rows.append((row, record.get("password")))
+
+    to_hash = [(row, password) for row, password in rows if password and not row["password_hash"]]
+    hashes = password_hasher.hash_many([password for _, password in to_hash])
+    for (row, _), password_hash in zip(to_hash, hashes):
+        row["password_hash"] = password_hash
+    return [row for row, _ in rows]
+
+
+def insert_statement():
+    """
+    INSERT skipping rows which conflict with any unique column, ``None``
+    on databases without such a clause.
+    """
+    table = User.__table__
+    dialect = db.engine.dialect.name
+    if dialect == "postgresql":
+        return postgresql.insert(table).on_conflict_do_nothing()
+    elif dialect == "sqlite":
+        return sqlite.insert(table).on_conflict_do_nothing()
+    elif dialect == "mysql":
+        return table.insert().prefix_with("IGNORE")
+    return None
+
+
+def without_conflicts(rows):
+    """
+    Drops rows whose email or username already exists or appears earlier in
+    ``rows``. Used where conflicts can't be skipped by the INSERT, users
+    created concurrently by others may still make the batch fail.
+    """
+    emails = [row["_email"] for row in rows]
+    usernames = [row["username"] for row in rows if row["username"]]
+    taken_emails = {email for email, in db.session.query(User._email).filter(
+        User._email.in_(emails))}
+    taken_usernames = {username for username, in db.session.query(User.username).filter(
+        User.username.in_(usernames))} if usernames else set()
+    kept = []
+    for row in rows:
+        if row["_email"] in taken_emails or row["username"] in taken_usernames:
+            continue
+        taken_emails.add(row["_email"])
+        if row["username"]:
+            taken_usernames.add(row["username"])
+        kept.append(row)
+    return kept
+
+
+def import_users(records, batch_size=1000):
+    """
+    Inserts users with one statement and one commit per batch, users whose
+    email or username already exists are skipped. Records may carry either
+    a plain ``password``, hashed in parallel, or an existing
+    ``password_hash``. Returns the number of inserted users.
+    """
+    statement = insert_statement()
+    records = iter(records)
+    inserted = 0
+    while True:
+        batch = list(itertools.islice(records, batch_size))
+        if not batch:
+            break
+        rows = prepare_rows(batch)
+        if statement is None:
+            rows = without_conflicts(rows)
+        if rows:
+            if statement is None:
+                result = db.session.execute(User.__table__.insert(), rows)
+            elif db.engine.dialect.name == "postgresql":
+                # One multi-row VALUES, psycopg2's executemany has no rowcount
+                result = db.session.execute(statement.values(rows))
+            else:
+                result = db.session.execute(statement, rows)
+            inserted += result.rowcount
+            model_versions.touch(User)
+            db.session.commit()
+    email_index.bump()
+    return inserted
+
+
+def update_users(query, **values):
+    """
+    Sets ``values`` on every user matched by ``query`` with one ``UPDATE``
+    and commits. Returns the number of updated users.
+    """
+    updated = query.order_by(None).update(values, synchronize_session=False)
+    db.session.commit()
+    user_identities.bump()
+    return updated
+
+
+def add_users_to_group(query, group_id):
+    """
+    Adds every user matched by ``query`` to the group with one
+    ``INSERT ... SELECT`` skipping the users already in it, and commits.
+    Returns the number of added users.
+    """
+    already_member = exists().where(and_(
+        user_group_table.c.user_id == User.id,
+        user_group_table.c.group_id == group_id,
+    ))
+    select = query.order_by(None).filter(~already_member).with_entities(
+        User.id, literal(group_id)).statement
+    result = db.session.execute(
+        user_group_table.insert().from_select(["user_id", "group_id"], select))
+    model_versions.touch(User)
+    db.session.commit()
+    permission_sets.bump()
+    return result.rowcount
+
+
+def remove_users_from_group(query, group_id):
+    """
+    Removes every user matched by ``query`` from the group with one
+    ``DELETE`` and commits. Returns the number of removed users.
+    """
+    user_ids = query.order_by(None).with_entities(User.id).subquery()
+    result = db.session.execute(user_group_table.delete().where(and_(
+        user_group_table.c.group_id == group_id,
+        user_group_table.c.user_id.in_(db.select([user_ids.c.id])),
+    )))
+    model_versions.touch(User)
+    db.session.commit()
+    permission_sets.bump()
+    return result.rowcount
@@ -0,0 +1,296 @@
+"""
+Per-worker caches used on the authentication hot path.
+"""
+
+import time
+import uuid
+import threading
+
+from datetime import datetime
+
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
+from flask import current_app
+
+from fardel.ext import db, cache
+
+__all__ = [
+    "RevokedTokenCache", "revoked_tokens",
+    "UserIdentityCache", "user_identities",
+    "PermissionSetCache", "permission_sets",
+    "CatalogCache", "catalogs",
+]
+
+
+class RevokedTokenCache(object):
+    """
+    Membership set of revoked JTIs kept in every worker.
+
+    The set is warmed from ``auth_revoked_tokens`` and afterwards only the
+    rows added since the last sync are pulled, at most once every
+    ``REVOKED_TOKEN_CACHE_TTL`` seconds. Ids are assigned before commit, so
+    concurrent revocations may commit out of order; every sync reads again
+    the last ``REVOKED_TOKEN_SYNC_OVERLAP`` ids below the highest one seen
+    to pick up rows which were committed late. Tokens revoked by this worker are
+    added immediately. A JTI found in the set is revoked for sure, so the
+    database is only asked again when ``REVOKED_TOKEN_CACHE_TTL`` is ``0``.
+
+    Every revocation also replaces a stamp in the cache backend, and a
+    worker seeing a new stamp syncs before trusting a miss. With a backend
+    shared between processes a logout is therefore seen by every worker
+    at once. With a per-process backend like ``simple``, a token revoked by
+    another worker is still accepted here for up to
+    ``REVOKED_TOKEN_CACHE_TTL`` seconds.
+    """
+    stamp_key = "auth:revoked:stamp"
+
+    def __init__(self):
+        self._jtis = {}
+        self._last_id = 0
+        self._stamp = None
+        self._synced_at = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.db_lookups = 0
+
+    @property
+    def ttl(self):
+        return current_app.config.get("REVOKED_TOKEN_CACHE_TTL", 30)
+
+    @property
+    def overlap(self):
+        return current_app.config.get("REVOKED_TOKEN_SYNC_OVERLAP", 100)
+
+    def warm(self):
+        with self._lock:
+            self._jtis = {}
+            self._last_id = 0
+            self._stamp = cache.get(self.stamp_key)
+            self._sync()
+
+    def _sync(self):
+        from .models import RevokedToken
+
+        rows = RevokedToken.query.with_entities(
+            RevokedToken.id, RevokedToken.jti, RevokedToken.expires_at).filter(
+            RevokedToken.id > self._last_id - self.overlap).all()
+        for row_id, jti, expires_at in rows:
+            self._jtis[jti] = expires_at
+            self._last_id = max(self._last_id, row_id)
+
+        now = datetime.utcnow()
+        expired = [jti for jti, expires_at in self._jtis.items()
+                   if expires_at is not None and expires_at < now]
+        for jti in expired:
+            del self._jtis[jti]
+        self._synced_at = time.monotonic()
+
+    def sync(self):
+        # Read before syncing, a revocation committed meanwhile changes it again
+        stamp = cache.get(self.stamp_key)
+        with self._lock:
+            if (stamp != self._stamp or self._synced_at is None
+                    or time.monotonic() - self._synced_at >= self.ttl):
+                self._stamp = stamp
+                self._sync()
+
+    def add(self, jti, expires_at=None):
+        """ Adds a token this worker revoked and tells the others to sync """
+        with self._lock:
+            self._jtis[jti] = expires_at
+        cache.set(self.stamp_key, uuid.uuid4().hex, timeout=0)
+
+    def is_revoked(self, jti):
+        from .models import RevokedToken
+
+        if not self.ttl:
+            self.db_lookups += 1
+            return RevokedToken.is_jti_blacklisted(jti)
+
+        self.sync()
+        if jti in self._jtis:
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def stats(self):
+        return {
+            "size": len(self._jtis),
+            "hits": self.hits,
+            "misses": self.misses,
+            "db_lookups": self.db_lookups,
+        }
+
+
+revoked_tokens = RevokedTokenCache()
+
+
+class UserIdentityCache(object):
+    """
+    Short lived cache of ``auth_users`` rows keyed by id and email.
+
+    Column values are kept in the configured ``cache`` backend for
+    ``USER_CACHE_TIMEOUT`` seconds and turned back into a persistent ``User``
+    attached to the current session without touching the database, so
+    relationships still lazy load and changes are flushed as usual. Every
+    write to a user must call :meth:`invalidate`, bulk writes call
+    :meth:`bump` which drops every entry at once.
+    """
+    version_key = "auth:user:version"
+    excluded = frozenset(["password_hash"])
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def timeout(self):
+        return current_app.config.get("USER_CACHE_TIMEOUT", 30)
+
+    def _id_key(self, user_id):
+        return "auth:user:id:%s" % user_id
+
+    def _email_key(self, email):
+        return "auth:user:email:%s" % email
+
+    def _attach(self, columns):
+        from .models import User
+
+        user = User(**columns)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    def version(self):
+        version = cache.get(self.version_key)
+        if version is None:
+            version = self.bump()
+        return version
+
+    def bump(self):
+        version = uuid.uuid4().hex
+        cache.set(self.version_key, version, timeout=0)
+        return version
+
+    def store(self, user, version=None):
+        # The password hash stays out of the shared backend, checking a
+        # password loads it from the database
+        columns = {attr.key: getattr(user, attr.key)
+                   for attr in inspect(type(user)).column_attrs
+                   if attr.key not in self.excluded}
+        version = version or self.version()
+        cache.set(self._id_key(user.id), (version, columns), timeout=self.timeout)
+        cache.set(self._email_key(user.email), user.id, timeout=self.timeout)
+
+    def by_id(self, user_id):
+        from .models import User
+
+        version, entry = cache.get_many(self.version_key, self._id_key(user_id))
+        if version is None:
+            version = self.bump()
+        if entry is not None and entry[0] == version:
+            self.hits += 1
+            return self._attach(entry[1])
+
+        self.misses += 1
+        user = User.query.filter_by(id=user_id).first()
+        if user:
+            self.store(user, version)
+        return user
+
+    def by_email(self, email):
+        from .models import User
+
+        user_id = cache.get(self._email_key(email))
+        if user_id is not None:
+            user = self.by_id(user_id)
+            if user and user.email == email:
+                return user
+
+        self.misses += 1
+        user = User.query.filter(User._email == email).scalar()
+        if user:
+            self.store(user)
+        return user
+
+    def invalidate(self, user_id):
+        cache.delete(self._id_key(user_id))
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+user_identities = UserIdentityCache()
+
+
+class PermissionSetCache(object):
+    """
+    Effective permissions of every user as a ``frozenset`` of code names.
+
+    Entries are stamped with a global version which is replaced by
+    :meth:`bump` whenever groups or their permissions are edited, so one call
+    invalidates every user at once. A user's entry alone is dropped with
+    :meth:`invalidate` when their groups change.
+    """
+    version_key = "auth:permissions:version"
+
+    @property
+    def timeout(self):
+        return current_app.config.get("PERMISSION_CACHE_TIMEOUT", 300)
+
+    def _key(self, user_id):
+        return "auth:permissions:user:%s" % user_id
+
+    def version(self):
+        version = cache.get(self.version_key)
+        if version is None:
+            version = self.bump()
+        return version
+
+    def bump(self):
+        version = uuid.uuid4().hex
+        cache.set(self.version_key, version, timeout=0)
+        return version
+
+    def get(self, user_id, loader):
+        version = self.version()
+        entry = cache.get(self._key(user_id))
+        if entry is not None and entry[0] == version:
+            return entry[1]
+
+        permissions = frozenset(loader())
+        cache.set(self._key(user_id), (version, permissions), timeout=self.timeout)
+        return permissions
+
+    def invalidate(self, user_id):
+        cache.delete(self._key(user_id))
+
+
+permission_sets = PermissionSetCache()
+
+
+class CatalogCache(object):
+    """
+    Small lookup tables like every group or permission, used to render the
+    panel forms. They are stamped with the permission version so editing
+    groups or permissions refreshes them.
+    """
+
+    @property
+    def timeout(self):
+        return current_app.config.get("PERMISSION_CACHE_TIMEOUT", 300)
+
+    def get(self, name, loader):
+        key = "auth:catalog:%s" % name
+        version = permission_sets.version()
+        entry = cache.get(key)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+
+        rows = loader()
+        cache.set(key, (version, rows), timeout=self.timeout)
+        return rows
+
+
+catalogs = CatalogCache()
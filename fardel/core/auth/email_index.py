@@ -0,0 +1,194 @@
+"""
+Per-worker sorted index of user emails for prefix lookups.
+"""
+
+import time
+import bisect
+import threading
+
+from threading import Thread
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+from flask import current_app
+
+from fardel.ext import db, cache
+
+from .models import User
+
+__all__ = ["EmailPrefixIndex", "email_index"]
+
+
+def merge_emails(emails, added, removed):
+    """ Sorted copy of ``emails`` with the changes applied """
+    emails = list(emails)
+    for email in removed:
+        i = bisect.bisect_left(emails, email)
+        if i < len(emails) and emails[i] == email:
+            del emails[i]
+    for email in added:
+        i = bisect.bisect_left(emails, email)
+        if i == len(emails) or emails[i] != email:
+            emails.insert(i, email)
+    return emails
+
+
+class EmailPrefixIndex(object):
+    """
+    Sorted list of every user email searched with ``bisect``.
+
+    Users created, edited or deleted through the ORM are published to the
+    cache backend as numbered changes. Other workers replay the changes
+    they haven't seen before a lookup. An index is only rebuilt from the
+    database, in a background thread while lookups go to the database, when
+    changes are missing, more than ``EMAIL_INDEX_MAX_CHANGES`` behind, or
+    the index is older than ``EMAIL_INDEX_MAX_AGE`` seconds.
+    """
+    sequence_key = "auth:emails:sequence"
+
+    def __init__(self):
+        self._emails = []
+        self._sequence = None
+        self._built_at = None
+        self._building = False
+        self._lock = threading.Lock()
+
+    def _change_key(self, sequence):
+        return "auth:emails:change:%d" % sequence
+
+    @property
+    def max_age(self):
+        return current_app.config.get("EMAIL_INDEX_MAX_AGE", 3600)
+
+    def sequence(self):
+        return cache.get(self.sequence_key) or 0
+
+    def bump(self):
+        """ Skips a change number, every worker rebuilds its index """
+        return cache.cache.inc(self.sequence_key)
+
+    def build(self):
+        sequence = self.sequence()
+        emails = [row[0] for row in db.session.query(User._email).order_by(User._email)]
+        with self._lock:
+            self._emails = emails
+            self._sequence = sequence
+            self._built_at = time.monotonic()
+            self._building = False
+        # Changes published while the query ran are replayed, that's harmless
+        self.catch_up()
+
+    def _build_in_background(self, app):
+        try:
+            with app.app_context():
+                self.build()
+        except Exception as err:
+            self._building = False
+            app.logger.exception("Couldn't build email index: %s" % err)
+
+    def rebuild(self):
+        with self._lock:
+            if self._building:
+                return
+            self._building = True
+        app = current_app._get_current_object()
+        Thread(target=self._build_in_background, args=[app]).start()
+
+    def catch_up(self):
+        """ Replays the changes of other workers, returns whether the index is usable """
+        if self._built_at is None or time.monotonic() - self._built_at > self.max_age:
+            return False
+        sequence = self.sequence()
+        start = self._sequence
+        if sequence == start:
+            return True
+        if sequence < start or sequence - start > current_app.config.get(
+                "EMAIL_INDEX_MAX_CHANGES", 1000):
+            return False
+        changes = cache.get_many(*[self._change_key(n) for n in range(start + 1, sequence + 1)])
+        if any(change is None for change in changes):
+            return False
+        with self._lock:
+            # Another thread may have replayed some of them meanwhile
+            emails = self._emails
+            for n, (added, removed) in enumerate(changes, start + 1):
+                if n > self._sequence:
+                    emails = merge_emails(emails, added, removed)
+            # search() reads the list without the lock, so it's swapped
+            self._emails = emails
+            self._sequence = max(self._sequence, sequence)
+        return True
+
+    def is_stale(self):
+        return not self.catch_up()
+
+    def apply(self, added, removed):
+        """ Publishes committed changes of this worker and applies them """
+        # Atomic on redis and memcached, so every change gets its own number
+        sequence = cache.cache.inc(self.sequence_key)
+        cache.set(self._change_key(sequence), (list(added), list(removed)), timeout=self.max_age)
+        with self._lock:
+            if self._sequence == sequence - 1:
+                self._emails = merge_emails(self._emails, added, removed)
+                self._sequence = sequence
+
+    def search(self, prefix, limit):
+        emails = self._emails
+        result = []
+        i = bisect.bisect_left(emails, prefix)
+        while i < len(emails) and len(result) < limit and emails[i].startswith(prefix):
+            result.append(emails[i])
+            i += 1
+        return result
+
+    def search_database(self, prefix, limit):
+        query = db.session.query(User._email).filter(
+            User._email.startswith(prefix, autoescape=True)).order_by(User._email).limit(limit)
+        return [row[0] for row in query]
+
+    def lookup(self, prefix, limit):
+        if not self.catch_up():
+            self.rebuild()
+            return self.search_database(prefix, limit)
+        return self.search(prefix, limit)
+
+
+email_index = EmailPrefixIndex()
+
+
+def pending_changes(session):
+    return session.info.setdefault("email_index", ([], []))
+
+
+@event.listens_for(User, "after_insert")
+def email_inserted(mapper, connection, target):
+    added, _ = pending_changes(inspect(target).session)
+    added.append(target.email)
+
+
+@event.listens_for(User, "after_update")
+def email_updated(mapper, connection, target):
+    history = inspect(target).attrs._email.history
+    if history.has_changes():
+        added, removed = pending_changes(inspect(target).session)
+        added.extend(history.added)
+        removed.extend(history.deleted)
+
+
+@event.listens_for(User, "after_delete")
+def email_deleted(mapper, connection, target):
+    _, removed = pending_changes(inspect(target).session)
+    removed.append(target.email)
+
+
+@event.listens_for(Session, "after_commit")
+def apply_email_changes(session):
+    added, removed = session.info.pop("email_index", ([], []))
+    if added or removed:
+        email_index.apply(added, removed)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def discard_email_changes(session, previous_transaction):
+    if previous_transaction.parent is None:
+        session.info.pop("email_index", None)
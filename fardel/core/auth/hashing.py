@@ -0,0 +1,108 @@
+"""
+Password hashing outside of the request threads.
+"""
+
+import os
+import threading
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+from flask import current_app
+from werkzeug.exceptions import ServiceUnavailable
+
+__all__ = ["PasswordHasher", "password_hasher", "HashingOverloaded", "get_rounds"]
+
+
+class HashingOverloaded(ServiceUnavailable):
+    description = "Too many password operations in progress, try again later."
+
+
+def _hashpw(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+
+def _checkpw(password, hashed):
+    return bcrypt.checkpw(password, hashed)
+
+
+def get_rounds(hashed):
+    """ Work factor of a bcrypt hash like ``$2b$12$...`` """
+    try:
+        return int(hashed.split("$")[2])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+class PasswordHasher(object):
+    """
+    Runs bcrypt on a pool of ``PASSWORD_HASHING_WORKERS`` processes.
+
+    At most ``PASSWORD_HASHING_QUEUE_SIZE`` operations may wait for a free
+    process, beyond that :class:`HashingOverloaded` is raised which ends the
+    request with 503 instead of piling up CPU bound work. With no workers
+    configured hashing runs inline.
+    """
+
+    def __init__(self):
+        self._executor = None
+        self._slots = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def rounds(self):
+        return current_app.config.get("BCRYPT_LOG_ROUNDS", 12)
+
+    def get_executor(self):
+        workers = current_app.config.get("PASSWORD_HASHING_WORKERS", 0)
+        if not workers:
+            return None
+
+        with self._lock:
+            # A forked server must not reuse the pool of its parent
+            if self._executor is None or self._pid != os.getpid():
+                queue_size = current_app.config.get("PASSWORD_HASHING_QUEUE_SIZE", 32)
+                self._executor = ProcessPoolExecutor(
+                    max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+                self._slots = threading.BoundedSemaphore(workers + queue_size)
+                self._pid = os.getpid()
+        return self._executor
+
+    def run(self, func, *args):
+        executor = self.get_executor()
+        if executor is None:
+            return func(*args)
+
+        if not self._slots.acquire(blocking=False):
+            raise HashingOverloaded()
+        try:
+            return executor.submit(func, *args).result()
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        return self.run(_hashpw, password.encode("utf8"), self.rounds).decode()
+
+    def hash_many(self, passwords):
+        """ Hashes a batch in parallel, meant for imports rather than requests """
+        executor = self.get_executor()
+        encoded = [password.encode("utf8") for password in passwords]
+        rounds = [self.rounds] * len(encoded)
+        if executor is None:
+            hashes = map(_hashpw, encoded, rounds)
+        else:
+            workers = current_app.config["PASSWORD_HASHING_WORKERS"]
+            chunksize = max(1, len(encoded) // (workers * 4))
+            hashes = executor.map(_hashpw, encoded, rounds, chunksize=chunksize)
+        return [hashed.decode() for hashed in hashes]
+
+    def check(self, password, hashed):
+        return self.run(_checkpw, password.encode("utf8"), hashed.encode("utf8"))
+
+    def needs_rehash(self, hashed):
+        return get_rounds(hashed) != self.rounds
+
+
+password_hasher = PasswordHasher()
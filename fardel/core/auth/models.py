@@ -1,9 +1,10 @@
 import json
-import time
-import bcrypt
+
+from datetime import datetime, timedelta
 
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm.attributes import flag_modified
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import selectinload, joinedload, lazyload
 
 from flask_babel import gettext
 from flask import current_app, jsonify, render_template
@@ -11,8 +12,16 @@ from flask_login import UserMixin
 
 from fardel.ext import db, jwt, login_manager
 from fardel.core.utils import random_string
+from fardel.core.serializers import Serializer
+from fardel.core.versions import model_versions
+
+from .cache import revoked_tokens, user_identities, permission_sets, catalogs
+from .hashing import password_hasher
 
-__all__ = ["User", "Permission", "Group", "RevokedToken", "setup_permissions"]
+__all__ = [
+    "User", "Permission", "Group", "RevokedToken", "VerificationToken",
+    "setup_permissions", "sync_permissions", "loader_options",
+]
 
 CONFIRM_EMAIL = "email_confirm"
 
@@ -30,30 +39,140 @@ def setup_permissions():
     Permission.setup_permissions()
 
 
+def registered_permissions():
+    """ ``Meta.permissions`` of every model loaded so far, core and apps """
+    permissions = {}
+    for model in AbstractModelWithPermission.registry:
+        meta = getattr(model, "Meta", None)
+        for code_name, name in getattr(meta, "permissions", ()):
+            permissions.setdefault(code_name, name)
+    return permissions
+
+
+def upsert_permissions_statement():
+    """
+    INSERT of permissions which renames existing ones instead of failing on
+    the unique ``code_name``, ``None`` on databases without ``ON CONFLICT``.
+    """
+    dialect = db.engine.dialect.name
+    if dialect == "postgresql":
+        statement = postgresql.insert(Permission.__table__)
+    elif dialect == "sqlite":
+        statement = sqlite.insert(Permission.__table__)
+    else:
+        return None
+    return statement.on_conflict_do_update(
+        index_elements=["code_name"],
+        set_={"name": statement.excluded.name},
+        where=Permission.__table__.c.name != statement.excluded.name)
+
+
+def sync_permissions(permissions=None):
+    """
+    Creates missing permissions and renames changed ones in one transaction
+    with a single SELECT and one upsert, so workers syncing at the same time
+    can't create duplicates. Syncs all registered permissions when none are
+    given, returns the created code names.
+    """
+    if permissions is None:
+        permissions = registered_permissions()
+    else:
+        permissions = dict(permissions)
+    if not permissions:
+        return []
+
+    existing = dict(db.session.query(Permission.code_name, Permission.name).filter(
+        Permission.code_name.in_(list(permissions))))
+    missing = [{"code_name": code_name, "name": name}
+               for code_name, name in permissions.items() if code_name not in existing]
+    renamed = [{"code_name": code_name, "name": name}
+               for code_name, name in permissions.items()
+               if code_name in existing and existing[code_name] != name]
+
+    upsert = upsert_permissions_statement()
+    if upsert is not None:
+        if missing or renamed:
+            db.session.execute(upsert, missing + renamed)
+    else:
+        table = Permission.__table__
+        if missing:
+            db.session.execute(table.insert(), missing)
+        if renamed:
+            db.session.execute(
+                table.update().where(table.c.code_name == db.bindparam("_code_name")).values(
+                    name=db.bindparam("_name")),
+                [{"_code_name": p["code_name"], "_name": p["name"]} for p in renamed])
+    db.session.commit()
+    if missing or renamed:
+        permission_sets.bump()
+    return [permission["code_name"] for permission in missing]
+
+
+def parse_ids(ids):
+    return {int(i) for i in ids if str(i).isdigit()}
+
+
+def replace_links(table, owner_column, owner_id, target_model, target_column, target_ids):
+    """
+    Makes the rows of the association ``table`` for ``owner_id`` point to
+    exactly ``target_ids`` by deleting and inserting only the difference.
+    Ids which don't exist in ``target_model`` are ignored, the caller commits.
+    """
+    owner_column = table.c[owner_column]
+    target_column = table.c[target_column]
+    target_ids = parse_ids(target_ids)
+
+    current = {row[0] for row in db.session.execute(
+        db.select([target_column]).where(owner_column == owner_id))}
+    removed = current - target_ids
+    added = target_ids - current
+    if added:
+        added = {row[0] for row in db.session.query(target_model.id).filter(
+            target_model.id.in_(added))}
+
+    if removed:
+        db.session.execute(table.delete().where(
+            owner_column == owner_id).where(target_column.in_(removed)))
+    if added:
+        db.session.execute(table.insert(), [
+            {owner_column.key: owner_id, target_column.key: target_id} for target_id in added])
+    return added, removed
+
+
 class AbstractModelWithPermission:
+    registry = []
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        AbstractModelWithPermission.registry.append(cls)
+
     @classmethod
     def setup_permissions(cls):
-        for permission in cls.Meta.permissions:
-            p = Permission.query.filter_by(code_name=permission[0]).first()
-            if not p:
-                p = Permission(code_name=permission[0], name=permission[1])
-                db.session.add(p)
-                db.session.commit()
+        sync_permissions(cls.Meta.permissions)
 
 
 class Permission(db.Model, AbstractModelWithPermission):
     __tablename__ = "auth_permissions"
     id = db.Column(db.Integer, primary_key=True, index=True)
     name = db.Column(db.String(64))
-    code_name = db.Column(db.String(64), index=True)
+    code_name = db.Column(db.String(64), index=True, unique=True)
 
     groups = db.relationship("Group", secondary="auth_groups_permissions")
 
     class Meta:
         permissions = (("can_get_permissions", "Can get permissions"),)
 
+    @staticmethod
+    def catalog():
+        return catalogs.get("permissions", lambda: [
+            {"id": row.id, "name": row.name, "code_name": row.code_name}
+            for row in db.session.query(
+                Permission.id, Permission.name, Permission.code_name).order_by(Permission.id)])
+
+    serializer = Serializer("name", "code_name")
+
     def dict(self):
-        return {"name": self.name, "code_name": self.code_name}
+        return self.serializer.dump(self)
 
 
 class Group(db.Model, AbstractModelWithPermission):
@@ -71,10 +190,21 @@ class Group(db.Model, AbstractModelWithPermission):
         perm = Permission.query.filter_by(code_name=permission).first()
         self.permissions.append(perm)
 
+    def set_permissions(self, permission_ids):
+        """ Replaces the permissions of a flushed group, the caller commits """
+        replace_links(GroupPermission.__table__, "group_id", self.id,
+                      Permission, "permission_id", permission_ids)
+        model_versions.touch(Group, GroupPermission)
+        db.session.expire(self, ["permissions"])
+
+    @staticmethod
+    def catalog():
+        return catalogs.get("groups", lambda: [
+            {"id": row.id, "name": row.name}
+            for row in db.session.query(Group.id, Group.name).order_by(Group.id)])
+
     def can(self, permission):
-        if permission in [perm.code_name for perm in self.permissions]:
-            return True
-        return False
+        return permission in {perm.code_name for perm in self.permissions}
 
     def dict(self):
         return {"id": self.id, "name": self.name, "permissions": [p.dict() for p in self.permissions]}
@@ -113,30 +243,14 @@ class User(db.Model, AbstractModelWithPermission, UserMixin):
     confirmed = db.Column(db.Boolean, default=False)
     deleted = db.Column(db.Boolean, default=False)
 
-    tokens = db.Column(db.JSON, default=[])
-
     class Meta:
         permissions = (("can_get_users", "Can get users"),)
 
     @staticmethod
     def _bootstrap(count):
-        from mimesis import Person
-
-        person = Person("en")
+        from .bulk import generate_users, import_users
 
-        for _ in range(count):
-            u = User(
-                email=person.email(),
-                confirmed=True,
-                first_name=person.name(),
-                last_name=person.surname(),
-            )
-
-            db.session.add(u)
-            try:
-                db.session.commit()
-            except IntegrityError:
-                db.session.rollback()
+        import_users(generate_users(count))
 
     @property
     def email(self):
@@ -152,42 +266,50 @@ class User(db.Model, AbstractModelWithPermission, UserMixin):
 
     @password.setter
     def password(self, _password):
-        self.password_hash = bcrypt.hashpw(
-            _password.encode("utf8"), bcrypt.gensalt()).decode()
+        self.password_hash = password_hasher.hash(_password)
 
     def check_password(self, _password):
-        return bcrypt.checkpw(_password.encode("utf8"), self.password.encode("utf8"))
+        if not self.password or not password_hasher.check(_password, self.password):
+            return False
+
+        if password_hasher.needs_rehash(self.password):
+            self.password = _password
+            db.session.commit()
+            user_identities.invalidate(self.id)
+        return True
 
     def generate_token(self, token_type):
         token = random_string(length=6)
-        if not self.tokens:
-            self.tokens = []
-        self.tokens.append(
-            {"token_type": token_type, "expire_at": time.time() + 3600, "token": token})
-        if len(self.tokens) > 6:
-            self.tokens.pop(0)
-        flag_modified(self, "tokens")
-        db.session.add(self)
+        db.session.add(VerificationToken(
+            user_id=self.id, token_type=token_type, token=token,
+            expires_at=datetime.utcnow() + timedelta(seconds=3600)))
         db.session.commit()
         return token
 
     def confirm_token(self, token, token_type):
-        for t in self.tokens:
-            if t["token"] == token and t["token_type"] == token_type and t["expire_at"] > time.time():
-                self.tokens.remove(t)
-                flag_modified(self, "tokens")
-                db.session.add(self)
-                db.session.commit()
-                return True
+        if VerificationToken.consume(self.id, token, token_type):
+            db.session.commit()
+            return True
         return False
 
+    def count_active_tokens(self, token_type):
+        return VerificationToken.count_active(self.id, token_type)
+
+    def set_groups(self, group_ids):
+        """ Replaces the groups of a flushed user, the caller commits """
+        replace_links(user_group_table, "user_id", self.id, Group, "group_id", group_ids)
+        model_versions.touch(User)
+        db.session.expire(self, ["groups"])
+
     def set_admin(self):
         self.is_admin = True
         db.session.commit()
+        user_identities.invalidate(self.id)
 
     def set_staff(self):
         self.is_staff = True
         db.session.commit()
+        user_identities.invalidate(self.id)
 
     def get_confirmed(self):
         if self.confirmed:
@@ -217,29 +339,41 @@ class User(db.Model, AbstractModelWithPermission, UserMixin):
         }
 
     def confirm_email_with_token(self, token):
-        if self.confirm_token(token, CONFIRM_EMAIL):
+        if VerificationToken.consume(self.id, token, CONFIRM_EMAIL):
             self.confirmed = True
             db.session.add(self)
             db.session.commit()
+            user_identities.invalidate(self.id)
             return True
         return False
 
+    def load_permission_set(self):
+        query = db.session.query(Permission.code_name).join(
+            GroupPermission, GroupPermission.permission_id == Permission.id
+        ).join(
+            user_group_table, user_group_table.c.group_id == GroupPermission.group_id
+        ).filter(user_group_table.c.user_id == self.id).distinct()
+        return [row.code_name for row in query]
+
+    @property
+    def permission_set(self):
+        """ Code names of all permissions granted by the user's groups """
+        permissions = getattr(self, "_permission_set", None)
+        if permissions is None:
+            permissions = permission_sets.get(self.id, self.load_permission_set)
+            self._permission_set = permissions
+        return permissions
+
     def can(self, permission):
         if self.is_admin:
             return True
-        elif self.group:
-            return self.group.can(permission)
-        return False
+        return permission in self.permission_set
+
+    serializer = Serializer(
+        "id", "first_name", "last_name", ("email", "_email"), ("is_confirmed", "confirmed"))
 
     def dict(self):
-        obj = {
-            "id": self.id,
-            "first_name": self.first_name,
-            "last_name": self.last_name,
-            "email": self.email,
-            "is_confirmed": self.confirmed,
-        }
-        return obj
+        return self.serializer.dump(self)
 
     def access_dict(self):
         obj = {}
@@ -255,14 +389,43 @@ class User(db.Model, AbstractModelWithPermission, UserMixin):
         return "<User email='%s' id=%d>" % (self.email, self.id)
 
 
-class RevokedToken(db.Model):
+class ExpiringModelMixin(object):
+    expires_at = db.Column(db.DateTime, index=True)
+
+    @classmethod
+    def purge_expired(cls, batch_size=1000):
+        """ Deletes rows which are already expired in batches, returns the count """
+        purged = 0
+        while True:
+            ids = [row.id for row in db.session.query(cls.id).filter(
+                cls.expires_at < datetime.utcnow()).limit(batch_size)]
+            if not ids:
+                break
+            purged += cls.query.filter(cls.id.in_(ids)).delete(synchronize_session=False)
+            db.session.commit()
+        return purged
+
+
+class RevokedToken(db.Model, ExpiringModelMixin):
     __tablename__ = "auth_revoked_tokens"
     id = db.Column(db.Integer, primary_key=True)
-    jti = db.Column(db.String(120))
+    jti = db.Column(db.String(120), index=True, unique=True, nullable=False)
+
+    @classmethod
+    def revoke(cls, jwt_payload):
+        exp = jwt_payload.get("exp")
+        revoked_token = cls(jti=jwt_payload["jti"],
+                            expires_at=datetime.utcfromtimestamp(exp) if exp else None)
+        revoked_token.add()
+        return revoked_token
 
     def add(self):
         db.session.add(self)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+        revoked_tokens.add(self.jti, self.expires_at)
 
     @classmethod
     def is_jti_blacklisted(cls, jti):
@@ -270,15 +433,77 @@ class RevokedToken(db.Model):
         return bool(query)
 
 
+class VerificationToken(db.Model, ExpiringModelMixin):
+    __tablename__ = "auth_verification_tokens"
+    __table_args__ = (
+        db.Index("ix_auth_verification_tokens_lookup", "user_id", "token_type", "token"),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("auth_users.id", ondelete="CASCADE"), nullable=False)
+    token_type = db.Column(db.String(32), nullable=False)
+    token = db.Column(db.String(16), nullable=False)
+
+    @classmethod
+    def active(cls, user_id, token_type):
+        return cls.query.filter(
+            cls.user_id == user_id,
+            cls.token_type == token_type,
+            cls.expires_at > datetime.utcnow(),
+        )
+
+    @classmethod
+    def count_active(cls, user_id, token_type):
+        return cls.active(user_id, token_type).count()
+
+    @classmethod
+    def consume(cls, user_id, token, token_type):
+        """
+        Deletes the token with a single statement if it exists and is not
+        expired, the caller commits. Returns whether a token was consumed.
+        """
+        deleted = cls.active(user_id, token_type).filter(
+            cls.token == token).delete(synchronize_session=False)
+        return deleted > 0
+
+
+LOADER_STRATEGIES = {
+    "selectin": selectinload,
+    "joined": joinedload,
+    "lazy": lazyload,
+}
+
+LOADER_PROFILES = {
+    "user_access": ((User.groups, Group.permissions),),
+    "user_groups": ((User.groups,),),
+    "group_permissions": ((Group.permissions,),),
+}
+
+
+def loader_options(profile):
+    """
+    Query options which eager load the relationship paths of a profile with
+    the strategy set for it in ``AUTH_LOADER_STRATEGIES``.
+    """
+    strategies = current_app.config.get("AUTH_LOADER_STRATEGIES", {})
+    strategy = LOADER_STRATEGIES[strategies.get(profile, "selectin")]
+    options = []
+    for path in LOADER_PROFILES[profile]:
+        option = strategy(path[0])
+        for attribute in path[1:]:
+            option = getattr(option, strategy.__name__)(attribute)
+        options.append(option)
+    return options
+
+
 @jwt.user_lookup_loader
 def identify(headers, payload):
-    return User.query.filter(User._email == payload.get('sub')).scalar()
+    return user_identities.by_email(payload.get('sub'))
 
 
 @jwt.token_in_blocklist_loader
 def check_if_token_in_blacklist(jwt_headers, jwt_payload):
     jti = jwt_payload["jti"]
-    return RevokedToken.is_jti_blacklisted(jti)
+    return revoked_tokens.is_revoked(jti)
 
 
 @jwt.revoked_token_loader
@@ -303,4 +528,4 @@ def needs_fresh_token_loader(jwt_headers, jwt_payload):
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.filter_by(id=user_id).first()
+    return user_identities.by_id(int(user_id))
@@ -63,8 +63,6 @@ Revoked token:
 
         {"message":"Token has been revoked"}
 """
-import time
-
 from sqlalchemy import or_
 from flask import render_template, redirect, url_for, jsonify, request, make_response, current_app
 
@@ -81,6 +79,8 @@ from fardel.core import email as email_pkg
 
 from . import mod
 from .models import *
+from .models import CONFIRM_EMAIL
+from .cache import revoked_tokens, user_identities
 
 
 auth_api = create_api(mod)
@@ -88,7 +88,13 @@ auth_api = create_api(mod)
 
 @mod.before_app_first_request
 def create_permissions():
-    setup_permissions()
+    if current_app.config["SYNC_PERMISSIONS_ON_FIRST_REQUEST"]:
+        sync_permissions()
+
+
+@mod.before_app_first_request
+def warm_revoked_tokens():
+    revoked_tokens.warm()
 
 
 def rest_resource(resource_cls):
@@ -213,6 +219,14 @@ class LoginApi(BaseResource):
                 .. code-block:: json
 
                     {"message":"Username or password is not correct"}
+
+            If too many passwords are being checked at the moment:
+
+            :status_code: 503
+            :response:
+                .. code-block:: json
+
+                    {"message":"Too many password operations in progress, try again later."}
         """
         data = request.get_json()
         if not self.check_data(data, ['email', 'password']):
@@ -221,7 +235,7 @@ class LoginApi(BaseResource):
         password = data['password']
         email = data['email']
 
-        u = User.query.filter_by(_email=email).scalar()
+        u = User.query.options(*loader_options("user_access")).filter_by(_email=email).scalar()
         if u and u.check_password(password):
             access_token = create_access_token(identity=u.email)
             refresh_token = create_refresh_token(identity=u.email)
@@ -259,9 +273,7 @@ class LogoutApi(BaseResource):
                     "message": "Access token has been revoked"
                 }
         """
-        jti = get_jwt()['jti']
-        revoked_token = RevokedToken(jti=jti)
-        revoked_token.add()
+        RevokedToken.revoke(get_jwt())
         return {'message': 'Access token has been revoked'}
 
 
@@ -285,9 +297,7 @@ class LogoutRefreshApi(BaseResource):
                     "message": "Refresh token has been revoked"
                 }
         """
-        jti = get_jwt()['jti']
-        revoked_token = RevokedToken(jti=jti)
-        revoked_token.add()
+        RevokedToken.revoke(get_jwt())
         return {'message': 'Refresh token has been revoked'}
 
 
@@ -338,8 +348,11 @@ class ProfileApi(BaseResource):
                 {
                     "user": UserObject
                 }
+
+        Responses carry a weak ETag, sending it back in ``If-None-Match``
+        gets an empty 304 while the profile is unchanged.
         """
-        return {"user": current_user.dict()}
+        return self.conditional({"user": current_user.dict()})
 
     def put(self):
         """
@@ -366,6 +379,7 @@ class ProfileApi(BaseResource):
                 setattr(current_user, field, data[field])
 
         db.session.commit()
+        user_identities.invalidate(current_user.id)
         return {"message": "Profile successfully updated",
                 'user': current_user.dict()}
 
@@ -377,16 +391,9 @@ class ConfirmEmailAPI(BaseResource):
     """
     endpoints = ['/confirm/email/', '/confirm/email/<token>/']
 
-    def count_active_tokens(self, tokens):
-        count = 0
-        for t in tokens:
-            if t['expire_at'] > time.time():
-                count += 1
-        return count
-
     @jwt_required()
     def get(self):
-        if current_user.tokens and self.count_active_tokens(current_user.tokens) > 2:
+        if current_user.count_active_tokens(CONFIRM_EMAIL) > 2:
             return {"message": "You have two active tokens"}, 403
 
         email = current_user.generate_registration_email()
@@ -1,17 +1,80 @@
+import datetime
+import itertools
+
 import sqlalchemy
-from flask import jsonify, request
+from flask import jsonify, request, Response, current_app, g
+from werkzeug.http import quote_etag
 
 from flask_restful import Resource, abort
 from flask_babel import gettext
 
 from fardel.ext import db
 
+from .utils import convert_timestamp, fingerprint
+from .jsonstream import read_json, JSONStreamError
+from .pagination import KeysetPage
+from .serializers import get_serializer
+from .versions import model_versions
+
 __all__ = (
-    'BaseResource', 'GetBaseResource'
+    'BaseResource', 'GetBaseResource', 'make_etag'
 )
 
 
+def make_etag(*parts):
+    """ Hash of JSON serializable ``parts`` used as a weak ETag """
+    return fingerprint(*parts)
+
+
 class BaseResource(Resource):
+    max_batch_size = None
+
+    def get_max_batch_size(self):
+        return self.max_batch_size or current_app.config.get("API_MAX_BATCH_SIZE", 1000)
+
+    def read_body(self):
+        """
+        Parses the JSON body while it's read. Returns ``(True, items)`` for
+        an array of at most ``max_batch_size`` items, otherwise
+        ``(False, data)``.
+        """
+        if not request.is_json:
+            return False, None
+        try:
+            is_batch, data = read_json(request.stream)
+            if is_batch:
+                limit = self.get_max_batch_size()
+                data = list(itertools.islice(data, limit + 1))
+                if len(data) > limit:
+                    abort(413, message=gettext("At most %(limit)d items are allowed", limit=limit))
+        except JSONStreamError:
+            abort(400, message=gettext("Invalid JSON body"))
+        g.json_body = data
+        return is_batch, data
+
+    def get_json(self):
+        """
+        The JSON body of the request. :meth:`read_body` consumes the stream,
+        so once it ran ``request.get_json()`` finds an empty body, use this.
+        """
+        if "json_body" in g:
+            return g.json_body
+        return request.get_json()
+
+    def not_modified(self, etag):
+        response = Response(status=304)
+        response.set_etag(etag, weak=True)
+        return response
+
+    def conditional(self, payload, etag=None):
+        """
+        Returns ``payload`` with a weak ETag, or an empty 304 when the client
+        already sent that ETag in ``If-None-Match``.
+        """
+        etag = etag or make_etag(payload)
+        if request.if_none_match.contains_weak(etag):
+            return self.not_modified(etag)
+        return payload, 200, {"ETag": quote_etag(etag, weak=True)}
 
     def bad_request(self):
         return {'message': gettext('Invalid form submitted')}, 400
@@ -37,7 +100,25 @@ class BaseResource(Resource):
 
 
 class GetBaseResource(BaseResource):
+    """
+    Lists are ordered by ``cursor_field`` and paged with ``?cursor=``, the
+    ``next_cursor`` of the previous response, and ``?limit=`` which is
+    capped at ``max_limit``. Columns named in ``list_fields`` may be picked
+    with ``?fields=a,b``, then only those columns are selected and returned
+    instead of ``obj.dict()``. When ``resource_class`` declares a
+    :class:`~fardel.core.serializers.Serializer` its columns are selected as
+    plain rows too, unless a subclass overrides ``dict()``.
+
+    Responses carry a weak ETag. For lists it is derived from the versions
+    of ``tracked_models`` when the cache backend is shared between
+    processes, so a matching ``If-None-Match`` is answered with 304 before
+    anything is queried. Otherwise it's the hash of the response.
+    """
     resource_class = None
+    list_fields = ()
+    cursor_field = "id"
+    default_limit = 32
+    max_limit = 100
 
     def check_implemented(self):
         if self.resource_class == None:
@@ -46,6 +127,37 @@ class GetBaseResource(BaseResource):
     def obj_id_required(self):
         return {"message": gettext("obj_id must be provided")}, 422
 
+    @property
+    def tracked_models(self):
+        """
+        Models whose writes change the responses, for ETags and
+        :func:`~fardel.core.utils.cache_get_key`. Override when joining others.
+        """
+        return (self.resource_class,)
+
+    def get_query(self):
+        return self.resource_class.query
+
+    def get_limit(self):
+        limit = request.args.get('limit', type=int, default=self.default_limit)
+        return max(1, min(limit, self.max_limit))
+
+    def get_fields(self):
+        fields = [f.strip() for f in request.args.get('fields', '').split(',') if f.strip()]
+        unknown = [f for f in fields if f not in self.list_fields]
+        if unknown:
+            abort(400, message=gettext("Unknown fields: %(fields)s", fields=", ".join(unknown)))
+        return list(dict.fromkeys(fields))
+
+    def row_dict(self, row, fields):
+        obj = {}
+        for field in fields:
+            value = getattr(row, field)
+            if isinstance(value, (datetime.date, datetime.datetime)):
+                value = convert_timestamp(value)
+            obj[field] = value
+        return obj
+
     def get(self, obj_id=None):
         self.check_implemented()
 
@@ -53,17 +165,56 @@ class GetBaseResource(BaseResource):
             u = self.resource_class.query.filter_by(id=obj_id).first()
             if not u:
                 return {"message": "%s not found" % self.resource_class.__name__}, 404
-            return {self.resource_class.__name__.lower(): u.dict()}
+            return self.conditional({self.resource_class.__name__.lower(): u.dict()})
         resource_name = "%ss" % self.resource_class.__name__.lower()
-        page = request.args.get('page', type=int, default=1)
-        return {
-            resource_name: [obj.dict() for obj in
-                            self.resource_class.query.paginate(
-                page=page, per_page=32, error_out=False).items]
-        }
+
+        # A list only changes with its models, so their versions identify it
+        # as long as every worker sees the same versions
+        etag = None
+        if model_versions.is_shared():
+            etag = make_etag(model_versions.versions(*self.tracked_models), request.path,
+                             sorted(request.args.items(multi=True)))
+            if request.if_none_match.contains_weak(etag):
+                return self.not_modified(etag)
+
+        column = getattr(self.resource_class, self.cursor_field)
+        fields = self.get_fields()
+        serializer = get_serializer(self.resource_class)
+        query = self.get_query()
+        if fields:
+            query = query.with_entities(*[
+                getattr(self.resource_class, f) for f in dict.fromkeys([self.cursor_field] + fields)])
+            dump = lambda row: self.row_dict(row, fields)
+        elif serializer is not None:
+            # Plain rows of the exposed columns, no objects are loaded
+            query = serializer.select(query, column)
+            dump = serializer.dump_row
+        else:
+            dump = self.resource_class.dict
+
+        limit = self.get_limit()
+        if 'page' in request.args and 'cursor' not in request.args:
+            # Offset pages are kept for older clients
+            page = max(request.args.get('page', type=int, default=1), 1)
+            items = query.order_by(column).offset((page - 1) * limit).limit(limit + 1).all()
+            next_cursor = getattr(items[limit - 1], self.cursor_field) if len(items) > limit else None
+            items = items[:limit]
+        else:
+            pagination = KeysetPage(query, column, limit, after=request.args.get(
+                'cursor', type=column.type.python_type))
+            items, next_cursor = pagination.items, pagination.next_cursor
+
+        return self.conditional({
+            resource_name: [dump(row) for row in items],
+            "next_cursor": next_cursor,
+        }, etag)
 
 
 class PostBaseResource(GetBaseResource):
+    """
+    Posting an array of objects creates all of them in one transaction and
+    returns a result for every item.
+    """
     required_to_create = None
     optional_fields = ()
 
@@ -72,18 +223,33 @@ class PostBaseResource(GetBaseResource):
         if self.required_to_create == None:
             raise NotImplementedError("required_to_create have to be assigned")
 
-    def post(self, obj_id=None):
-        self.check_implemented()
+    def validate(self, data):
+        """ Returns the fields to create an object with and an error message """
+        if not isinstance(data, dict):
+            return None, gettext('Invalid form submitted')
 
         fields = {}
-        data = request.get_json()
         for field in self.required_to_create:
             if not data.get(field):
-                return {'message': '%s must be provided.' % field}, 422
+                return None, '%s must be provided.' % field
             fields[field] = data[field]
 
         for field in self.optional_fields:
             fields[field] = data.get(field)
+        return fields, None
+
+    def post(self, obj_id=None):
+        self.check_implemented()
+
+        is_batch, data = self.read_body()
+        if is_batch:
+            return self.post_many(data)
+        if data is None:
+            return self.bad_request()
+
+        fields, error = self.validate(data)
+        if error:
+            return {'message': error}, 422
 
         obj = self.resource_class(**fields)
         db.session.add(obj)
@@ -96,12 +262,56 @@ class PostBaseResource(GetBaseResource):
             self.resource_class.__name__.lower(): obj.dict()
         }
 
+    def post_many(self, items):
+        name = self.resource_class.__name__
+        results = [None] * len(items)
+        objs = []
+        for i, data in enumerate(items):
+            fields, error = self.validate(data)
+            if error:
+                results[i] = {"status": 422, "message": error}
+            else:
+                objs.append((i, self.resource_class(**fields)))
+
+        try:
+            with db.session.begin_nested():
+                db.session.add_all([obj for _, obj in objs])
+        except sqlalchemy.exc.DBAPIError:
+            # Find the items at fault with one savepoint each
+            for i, obj in objs:
+                try:
+                    with db.session.begin_nested():
+                        db.session.add(obj)
+                except sqlalchemy.exc.IntegrityError:
+                    results[i] = {"status": 422, "message": "%s already exists" % name}
+                except sqlalchemy.exc.DBAPIError:
+                    results[i] = {"status": 422, "message": gettext("Invalid value")}
+
+        created = 0
+        for i, obj in objs:
+            if results[i] is None:
+                results[i] = {"status": 200, name.lower(): obj.dict()}
+                created += 1
+        db.session.commit()
+        return {
+            "message": "%d %ss successfully added" % (created, name),
+            "results": results,
+        }
+
 
 class DeleteBaseResource(GetBaseResource):
+    """
+    Sending a JSON array of ids instead of ``obj_id`` deletes all of them
+    with one statement and returns a result for every id.
+    """
+
     def delete(self, obj_id=None):
         self.check_implemented()
         if not obj_id:
-            abort(403)
+            is_batch, ids = self.read_body()
+            if not is_batch:
+                abort(403)
+            return self.delete_many(ids)
 
         deleteds = self.resource_class.query.filter_by(id=obj_id).delete()
         db.session.commit()
@@ -113,3 +323,27 @@ class DeleteBaseResource(GetBaseResource):
                     self.resource_class.__name__, deleteds
                 )}
         return {"message": "No %s deleted" % self.resource_class.__name__.lower()}, 404
+
+    def delete_many(self, ids):
+        name = self.resource_class.__name__
+        id_column = self.resource_class.id
+        valid = {i for i in ids if isinstance(i, int) and not isinstance(i, bool)}
+
+        existing = {row[0] for row in db.session.query(id_column).filter(id_column.in_(valid))}
+        if existing:
+            self.resource_class.query.filter(id_column.in_(existing)).delete(
+                synchronize_session=False)
+        db.session.commit()
+
+        results = []
+        for i in ids:
+            if not isinstance(i, int) or isinstance(i, bool):
+                results.append({"id": i, "status": 422, "message": gettext("Invalid id")})
+            elif i in existing:
+                results.append({"id": i, "status": 200})
+            else:
+                results.append({"id": i, "status": 404, "message": "%s not found" % name})
+        return {
+            "message": "%ss successfully deleted, count: %d" % (name, len(existing)),
+            "results": results,
+        }
@@ -0,0 +1,105 @@
+"""
+Full-text search inside PostgreSQL for models declaring ``search_fields``.
+
+A generated ``tsvector`` column built from the weighted fields and its GIN
+index are added with :func:`add_search_vector`, from a migration or the
+``fulltext-setup`` command. Searches match it with ``websearch_to_tsquery``
+and rank with ``ts_rank_cd``. Other databases, like the SQLite used by
+tests, fall back to ``LIKE`` on the fields.
+"""
+
+from sqlalchemy import and_, or_, false, func, inspect, literal_column
+from flask import current_app
+
+from fardel.ext import db
+
+from .indexer import field_weights, tokenize
+
+__all__ = [
+    "search_vector_ddl", "add_search_vector", "drop_search_vector",
+    "include_object", "search_query", "page_query",
+]
+
+COLUMN = "search_vector"
+WEIGHTS = "ABCD"
+
+
+def text_search_config():
+    return current_app.config.get("SEARCH_FULLTEXT_CONFIG", "simple")
+
+
+def weight_letters(model):
+    """ Maps the integer weights of ``search_fields`` to A, B, C and D """
+    weights = field_weights(model)
+    ranks = sorted(set(weights.values()), reverse=True)
+    return {field: WEIGHTS[min(ranks.index(weight), 3)] for field, weight in weights.items()}
+
+
+def search_vector_ddl(model, config="simple"):
+    table = model.__tablename__
+    columns = inspect(model).columns
+    vector = " || ".join(
+        "setweight(to_tsvector('%s'::regconfig, coalesce(\"%s\"::text, '')), '%s')" % (
+            config, columns[field].name, letter)
+        for field, letter in weight_letters(model).items())
+    return [
+        'ALTER TABLE "%s" ADD COLUMN IF NOT EXISTS %s tsvector '
+        'GENERATED ALWAYS AS (%s) STORED' % (table, COLUMN, vector),
+        'CREATE INDEX IF NOT EXISTS "ix_%s_%s" ON "%s" USING GIN (%s)' % (
+            table, COLUMN, table, COLUMN),
+    ]
+
+
+def add_search_vector(model, op=None, config=None):
+    """
+    Adds the generated column and its GIN index, PostgreSQL 12 or newer is
+    required. Pass alembic's ``op`` inside a migration, without it the
+    statements run on the current session which the caller commits.
+    """
+    execute = op.execute if op is not None else db.session.execute
+    for statement in search_vector_ddl(model, config or text_search_config()):
+        execute(db.text(statement))
+
+
+def drop_search_vector(model, op=None):
+    execute = op.execute if op is not None else db.session.execute
+    execute(db.text('DROP INDEX IF EXISTS "ix_%s_%s"' % (model.__tablename__, COLUMN)))
+    execute(db.text('ALTER TABLE "%s" DROP COLUMN IF EXISTS %s' % (model.__tablename__, COLUMN)))
+
+
+def include_object(obj, name, type_, reflected, compare_to):
+    """
+    ``include_object`` hook of alembic's autogenerate. The search vector and
+    its index aren't in the models' metadata, this keeps ``flask db migrate``
+    from dropping them. :class:`~fardel.manager.FardelManager` passes it to
+    Flask-Migrate.
+    """
+    if reflected and compare_to is None:
+        if type_ == "column" and name == COLUMN:
+            return False
+        if type_ == "index" and name.endswith("_%s" % COLUMN):
+            return False
+    return True
+
+
+def search_query(model, search_string):
+    """ Query of the matching objects, best ranked first """
+    if db.engine.dialect.name == "postgresql":
+        vector = literal_column('"%s".%s' % (model.__tablename__, COLUMN))
+        query = func.websearch_to_tsquery(text_search_config(), search_string)
+        return model.query.filter(vector.op("@@")(query)).order_by(
+            func.ts_rank_cd(vector, query).desc(), model.id)
+
+    # Every word has to appear in one of the fields
+    tokens = tokenize(search_string)
+    if not tokens:
+        return model.query.filter(false())
+    fields = [func.lower(getattr(model, field)) for field in field_weights(model)]
+    return model.query.filter(and_(*[
+        or_(*[field.contains(token, autoescape=True) for field in fields])
+        for token in tokens
+    ])).order_by(model.id)
+
+
+def page_query(model, search_string, page, per_page):
+    return search_query(model, search_string).limit(per_page).offset((page - 1) * per_page)
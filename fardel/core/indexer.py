@@ -0,0 +1,444 @@
+"""
+Inverted index for the models registered in ``fardel.core.models``.
+
+Models opt in by declaring ``search_fields``, either a tuple of column names
+or a dict mapping names to integer weights. Every model gets two files in
+``SEARCH_INDEX_DIR``:
+
+* ``<table>.idx``, a snapshot written by ``reindex`` and memory mapped by
+  every worker, so they share one copy through the page cache.
+* ``<table>.log``, an append-only log of the documents committed since the
+  snapshot was written. Workers replay its new lines before each search.
+  Once it grows past ``SEARCH_INDEX_COMPACT_BYTES`` the worker which wrote
+  to it rebuilds the snapshot in a background thread, which empties the log
+  and the overlays every worker keeps in memory.
+
+Both files are only changed while holding an exclusive ``flock`` on
+``<table>.lock``, readers take a shared one.
+"""
+
+import os
+import re
+import json
+import math
+import mmap
+import fcntl
+import struct
+import threading
+
+from collections import Counter
+from contextlib import contextmanager
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+from flask import current_app
+
+from fardel.ext import db
+
+__all__ = ["tokenize", "ModelIndex", "SearchIndex", "search_index", "reindex"]
+
+MAGIC = b"FDIX"
+VERSION = 1
+HEADER = struct.Struct("<4sIIIQQQQQ")
+DOC = struct.Struct("<QI")
+TERM = struct.Struct("<QIQI")
+POSTING = struct.Struct("<QII")
+
+K1 = 1.2
+B = 0.75
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text):
+    return [token.casefold() for token in TOKEN_RE.findall(text or "")]
+
+
+def field_weights(model):
+    fields = model.search_fields
+    if isinstance(fields, dict):
+        return fields
+    return {field: 1 for field in fields}
+
+
+def document_terms(model, values):
+    """ Weighted term frequencies and length of a document """
+    terms = Counter()
+    for field, weight in field_weights(model).items():
+        for token in tokenize(values.get(field)):
+            terms[token] += weight
+    return dict(terms), sum(terms.values())
+
+
+def write_snapshot(path, documents):
+    """
+    Writes ``documents``, an iterable of ``(id, terms, length)``, as a
+    snapshot. Terms are sorted by their UTF-8 bytes so lookups can bisect
+    the memory mapped term table.
+    """
+    docs = []
+    postings = {}
+    total_length = 0
+    for doc_id, terms, length in documents:
+        docs.append((doc_id, length))
+        total_length += length
+        for term, tf in terms.items():
+            postings.setdefault(term.encode("utf8"), []).append((doc_id, tf, length))
+    docs.sort()
+
+    terms = sorted(postings)
+    docs_offset = HEADER.size
+    terms_offset = docs_offset + DOC.size * len(docs)
+    postings_offset = terms_offset + TERM.size * len(terms)
+    blob_offset = postings_offset + POSTING.size * sum(len(p) for p in postings.values())
+
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(docs), len(terms), total_length,
+                            docs_offset, terms_offset, postings_offset, blob_offset))
+        for doc in docs:
+            f.write(DOC.pack(*doc))
+        position = blob = 0
+        for term in terms:
+            f.write(TERM.pack(blob, len(term), position, len(postings[term])))
+            blob += len(term)
+            position += len(postings[term])
+        for term in terms:
+            for posting in postings[term]:
+                f.write(POSTING.pack(*posting))
+        for term in terms:
+            f.write(term)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+class Snapshot(object):
+    """ Read only view of a snapshot file through ``mmap`` """
+
+    def __init__(self, path):
+        self.mm = None
+        self.doc_count = self.term_count = self.total_length = 0
+        if not os.path.exists(path):
+            return
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.doc_count, self.term_count, self.total_length,
+         self.docs_offset, self.terms_offset, self.postings_offset,
+         self.blob_offset) = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not a search index snapshot" % path)
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+
+    def _term(self, i):
+        blob, length, position, count = TERM.unpack_from(self.mm, self.terms_offset + i * TERM.size)
+        start = self.blob_offset + blob
+        return self.mm[start:start + length], position, count
+
+    def postings(self, term):
+        """ ``(doc_id, tf, length)`` of every document containing ``term`` """
+        if self.mm is None:
+            return []
+        term = term.encode("utf8")
+        lo, hi = 0, self.term_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._term(mid)[0] < term:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == self.term_count:
+            return []
+        found, position, count = self._term(lo)
+        if found != term:
+            return []
+        start = self.postings_offset + position * POSTING.size
+        return [POSTING.unpack_from(self.mm, start + i * POSTING.size) for i in range(count)]
+
+    def length(self, doc_id):
+        """ Length of the document or ``None`` when it isn't in the snapshot """
+        if self.mm is None:
+            return None
+        lo, hi = 0, self.doc_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if DOC.unpack_from(self.mm, self.docs_offset + mid * DOC.size)[0] < doc_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.doc_count:
+            found, length = DOC.unpack_from(self.mm, self.docs_offset + lo * DOC.size)
+            if found == doc_id:
+                return length
+        return None
+
+
+class ModelIndex(object):
+    """
+    Index of one model: the shared snapshot plus an overlay of the
+    documents found in the log, which replace their snapshot version.
+    """
+
+    def __init__(self, model, directory):
+        self.model = model
+        name = model.__tablename__
+        self.snapshot_path = os.path.join(directory, "%s.idx" % name)
+        self.log_path = os.path.join(directory, "%s.log" % name)
+        self.lock_path = os.path.join(directory, "%s.lock" % name)
+        self.compact_lock_path = os.path.join(directory, "%s.compact" % name)
+        self.snapshot = None
+        self.snapshot_stat = None
+        self.compactor = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def file_lock(self, operation):
+        with open(self.lock_path, "a") as f:
+            fcntl.flock(f, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _reset(self):
+        if self.snapshot is not None:
+            self.snapshot.close()
+        self.snapshot = Snapshot(self.snapshot_path)
+        self.log_offset = 0
+        self.overlay = {}
+        self.overlay_postings = {}
+        self.doc_count = self.snapshot.doc_count
+        self.total_length = self.snapshot.total_length
+
+    def _apply(self, entry):
+        doc_id = entry["id"]
+        if doc_id in self.overlay:
+            terms, length = self.overlay[doc_id]
+            for term in terms or ():
+                del self.overlay_postings[term][doc_id]
+        else:
+            length = self.snapshot.length(doc_id)
+        if length is not None:
+            self.doc_count -= 1
+            self.total_length -= length
+
+        terms = entry.get("terms")
+        length = entry.get("length", 0)
+        self.overlay[doc_id] = (terms, length if terms is not None else None)
+        if terms is not None:
+            self.doc_count += 1
+            self.total_length += length
+            for term, tf in terms.items():
+                self.overlay_postings.setdefault(term, {})[doc_id] = tf
+
+    def refresh(self):
+        """ Maps a new snapshot if ``reindex`` replaced it and replays the log """
+        with self.file_lock(fcntl.LOCK_SH):
+            try:
+                stat = os.stat(self.snapshot_path)
+                stat = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            except FileNotFoundError:
+                stat = None
+            if self.snapshot is None or stat != self.snapshot_stat:
+                self._reset()
+                self.snapshot_stat = stat
+
+            try:
+                with open(self.log_path, "rb") as f:
+                    f.seek(self.log_offset)
+                    data = f.read()
+            except FileNotFoundError:
+                return
+        # Only replay complete lines, a partial one is read again next time
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            if line:
+                self._apply(json.loads(line))
+        self.log_offset += end
+
+    def append(self, entries):
+        lines = "".join(json.dumps(entry, separators=(",", ":")) + "\n" for entry in entries)
+        with self.file_lock(fcntl.LOCK_EX):
+            with open(self.log_path, "a", encoding="utf8") as f:
+                f.write(lines)
+                size = f.tell()
+        limit = current_app.config.get("SEARCH_INDEX_COMPACT_BYTES", 0)
+        if limit and size >= limit:
+            self.compact_in_background(current_app._get_current_object(), limit)
+
+    def compact(self, limit):
+        """
+        Rebuilds the snapshot if the log is still ``limit`` bytes or larger
+        and no other worker is compacting it, returns whether it did.
+        """
+        with open(self.compact_lock_path, "a") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            try:
+                # Another worker may have compacted it meanwhile
+                if os.path.getsize(self.log_path) < limit:
+                    return False
+                self.rebuild()
+                return True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def compact_in_background(self, app, limit):
+        def run():
+            try:
+                with app.app_context():
+                    self.compact(limit)
+            except Exception as err:
+                app.logger.exception("Compacting the index of %s failed: %s" % (
+                    self.model.__name__, err))
+
+        with self._lock:
+            if self.compactor is not None and self.compactor.is_alive():
+                return
+            self.compactor = threading.Thread(
+                target=run, name="fardel-index-compact", daemon=True)
+            self.compactor.start()
+
+    def scores(self, query):
+        """ BM25 score of every document matching a term of ``query`` """
+        terms = set(tokenize(query))
+        with self._lock:
+            self.refresh()
+            if not self.doc_count:
+                return {}
+            average_length = self.total_length / self.doc_count
+            scores = {}
+            for term in terms:
+                matches = [(doc_id, tf, length) for doc_id, tf, length
+                           in self.snapshot.postings(term) if doc_id not in self.overlay]
+                matches.extend((doc_id, tf, self.overlay[doc_id][1])
+                               for doc_id, tf in self.overlay_postings.get(term, {}).items())
+                if not matches:
+                    continue
+                idf = math.log(1 + (self.doc_count - len(matches) + 0.5) / (len(matches) + 0.5))
+                for doc_id, tf, length in matches:
+                    scores[doc_id] = scores.get(doc_id, 0) + idf * tf * (K1 + 1) / (
+                        tf + K1 * (1 - B + B * length / average_length))
+        return scores
+
+    def search_ids(self, query, page, per_page):
+        """ Ids of the requested page, best ranked first """
+        scores = self.scores(query)
+        ranked = sorted(scores, key=lambda doc_id: (-scores[doc_id], doc_id))
+        return ranked[(page - 1) * per_page:page * per_page]
+
+    def documents(self, batch_size=1000):
+        fields = list(field_weights(self.model))
+        columns = [getattr(self.model, field) for field in fields]
+        query = db.session.query(self.model.id, *columns).order_by(self.model.id)
+        for row in query.yield_per(batch_size):
+            terms, length = document_terms(self.model, dict(zip(fields, row[1:])))
+            yield row[0], terms, length
+
+    def rebuild(self, batch_size=1000):
+        """
+        Writes a new snapshot from the database. Log lines appended while it
+        is being built are kept, replaying them again is harmless.
+        """
+        with self.file_lock(fcntl.LOCK_EX):
+            start = os.path.getsize(self.log_path) if os.path.exists(self.log_path) else 0
+
+        write_snapshot(self.snapshot_path + ".tmp", self.documents(batch_size))
+
+        with self.file_lock(fcntl.LOCK_EX):
+            tail = b""
+            if os.path.exists(self.log_path):
+                with open(self.log_path, "rb") as f:
+                    f.seek(start)
+                    tail = f.read()
+            with open(self.log_path + ".tmp", "wb") as f:
+                f.write(tail)
+            os.replace(self.log_path + ".tmp", self.log_path)
+            os.replace(self.snapshot_path + ".tmp", self.snapshot_path)
+
+
+class SearchIndex(object):
+    """ One :class:`ModelIndex` per searchable model, created on first use """
+
+    def __init__(self):
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def get(self, model):
+        with self._lock:
+            if model not in self._indexes:
+                directory = str(current_app.config["SEARCH_INDEX_DIR"])
+                os.makedirs(directory, exist_ok=True)
+                self._indexes[model] = ModelIndex(model, directory)
+            return self._indexes[model]
+
+    def search_ids(self, model, query, page, per_page):
+        return self.get(model).search_ids(query, page, per_page)
+
+
+search_index = SearchIndex()
+
+
+def searchable_models():
+    from . import models
+
+    return [model for model in models if getattr(model, "search_fields", None)]
+
+
+def reindex(batch_size=1000):
+    """ Rebuilds the snapshot of every searchable model """
+    rebuilt = []
+    for model in searchable_models():
+        search_index.get(model).rebuild(batch_size)
+        rebuilt.append(model)
+    return rebuilt
+
+
+def is_active():
+    return current_app.config.get("SEARCH_BACKEND") == "index"
+
+
+@event.listens_for(Session, "after_flush")
+def collect_documents(session, flush_context):
+    """
+    Tokenizes flushed objects while their values are loaded, they're
+    written to the log once the transaction commits.
+    """
+    models = searchable_models()
+    if not models or not is_active():
+        return
+    pending = session.info.setdefault("search_index", [])
+    for obj in session.new | session.dirty:
+        model = type(obj)
+        if model in models:
+            state = inspect(obj)
+            fields = field_weights(model)
+            if obj in session.dirty and not any(
+                    state.attrs[field].history.has_changes() for field in fields):
+                continue
+            terms, length = document_terms(model, {field: getattr(obj, field) for field in fields})
+            pending.append((model, {"id": obj.id, "terms": terms, "length": length}))
+    for obj in session.deleted:
+        if type(obj) in models:
+            pending.append((type(obj), {"id": obj.id}))
+
+
+@event.listens_for(Session, "after_commit")
+def write_documents(session):
+    pending = session.info.pop("search_index", None)
+    if not pending:
+        return
+    entries = {}
+    for model, entry in pending:
+        entries.setdefault(model, []).append(entry)
+    for model, model_entries in entries.items():
+        search_index.get(model).append(model_entries)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def discard_documents(session, previous_transaction):
+    if previous_transaction.parent is None:
+        session.info.pop("search_index", None)
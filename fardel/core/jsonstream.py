@@ -0,0 +1,100 @@
+"""
+Incremental parsing of JSON request bodies, so large arrays are decoded
+item by item instead of being read and parsed as a whole.
+"""
+
+import json
+import codecs
+
+__all__ = ["read_json", "JSONStreamError"]
+
+WHITESPACE = " \t\n\r"
+
+
+class JSONStreamError(ValueError):
+    pass
+
+
+class JSONStream(object):
+
+    def __init__(self, stream, chunk_size=65536):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.pos = 0
+        self.exhausted = False
+
+    def fill(self):
+        if self.exhausted:
+            return False
+        chunk = self.stream.read(self.chunk_size)
+        self.exhausted = not chunk
+        self.buffer = self.buffer[self.pos:] + self.utf8.decode(chunk or b"", final=self.exhausted)
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """ Next character which isn't whitespace, ``None`` at the end """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return None
+
+    def expect(self, *chars):
+        char = self.peek()
+        if char not in chars:
+            raise JSONStreamError("Expected %s at position %d" % (" or ".join(chars), self.pos))
+        self.pos += 1
+        return char
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError as err:
+                if self.fill():
+                    continue
+                raise JSONStreamError(str(err))
+            # A number at the end of the buffer may continue in the next chunk
+            if end == len(self.buffer) and self.fill():
+                continue
+            self.pos = end
+            return value
+
+    def items(self):
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+        else:
+            while True:
+                yield self.value()
+                if self.expect(",", "]") == "]":
+                    break
+        if self.peek() is not None:
+            raise JSONStreamError("Extra data at position %d" % self.pos)
+
+    def rest(self):
+        while self.fill():
+            pass
+        return self.buffer[self.pos:]
+
+
+def read_json(stream, chunk_size=65536):
+    """
+    Returns ``(True, items)`` for an array body, where ``items`` yields its
+    items while the body is being read, otherwise ``(False, document)``.
+    :class:`JSONStreamError` is raised for malformed bodies.
+    """
+    parser = JSONStream(stream, chunk_size)
+    if parser.peek() == "[":
+        return True, parser.items()
+    try:
+        return False, json.loads(parser.rest() or "null")
+    except json.JSONDecodeError as err:
+        raise JSONStreamError(str(err))
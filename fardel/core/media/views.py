@@ -9,12 +9,6 @@ All files are accessible through this url
 from flask import send_file, current_app
 
 from . import mod
-from .models import setup_permissions
-
-
-@mod.before_app_first_request
-def create_permissions():
-    setup_permissions()
 
 
 @mod.route('/uploads/<path:path_to_file>')
@@ -0,0 +1,33 @@
+"""
+Pagination of queries on large tables, shared by the REST API and the panel.
+"""
+
+__all__ = ["KeysetPage"]
+
+
+class KeysetPage(object):
+    """
+    One page of ``query`` ordered by the unique ``column``. Instead of an
+    OFFSET, pages are addressed by the ``column`` value of the last item
+    (``after``) or of the first item (``before``), so any page costs the
+    same as the first one.
+    """
+
+    def __init__(self, query, column, per_page, after=None, before=None):
+        self.per_page = per_page
+        if before is not None:
+            items = query.filter(column < before).order_by(column.desc()).limit(per_page + 1).all()
+            self.has_prev = len(items) > per_page
+            self.has_next = True
+            items = list(reversed(items[:per_page]))
+        else:
+            if after is not None:
+                query = query.filter(column > after)
+            items = query.order_by(column).limit(per_page + 1).all()
+            self.has_next = len(items) > per_page
+            self.has_prev = after is not None
+            items = items[:per_page]
+
+        self.items = items
+        self.next_cursor = getattr(items[-1], column.key) if items and self.has_next else None
+        self.prev_cursor = getattr(items[0], column.key) if items and self.has_prev else None
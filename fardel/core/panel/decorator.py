@@ -1,12 +1,18 @@
 from functools import wraps
-from flask import abort
+from flask import abort, current_app, g, request
 
 from flask_jwt_extended import current_user
 from flask_login import current_user as fl_current_user
+from flask_login.config import EXEMPT_METHODS
 from flask_restful import abort as rest_abort
 
 __all__ = [
+    'AccessPolicy',
+    'Principal',
+    'access_required',
+    'access_required_rest',
     'permission_required',
+    'permission_required_rest',
     'staff_required',
     'staff_required_rest',
     'admin_required',
@@ -14,67 +20,182 @@ __all__ = [
 ]
 
 
-def permission_required(permission):
-    def decorator(f):
-        @wraps(f)
-        def decorated_function(*args, **kwargs):
-            if fl_current_user and fl_current_user.can(permission):
-                return f(*args, **kwargs)
-            return abort(403)
-        return decorated_function
-    return decorator
-
-
-def permission_required_rest(permission):
-    def decorator(f):
-        @wraps(f)
-        def decorated_function(*args, **kwargs):
-            if current_user and current_user.can(permission):
-                return f(*args, **kwargs)
-            return rest_abort(403)
-        return decorated_function
-    return decorator
-
-
-def staff_required(func):
-    if not hasattr(func, 'decorators'):
-        func.decorators = {}
-    func.decorators['staff_required'] = True
+class Principal(object):
+    """
+    The user of the current request with the attributes access checks need,
+    built once per request and kept on ``g``.
+    """
+    __slots__ = ('user', 'is_authenticated', 'is_staff', 'is_admin', '_permissions')
+
+    def __init__(self, user):
+        self.user = user
+        self.is_authenticated = bool(user) and bool(getattr(user, 'is_authenticated', True))
+        self.is_admin = self.is_authenticated and bool(getattr(user, 'is_admin', False))
+        self.is_staff = self.is_authenticated and bool(getattr(user, 'is_staff', False))
+        self._permissions = {}
+
+    def can(self, permission):
+        if permission not in self._permissions:
+            self._permissions[permission] = self.is_authenticated and self.user.can(permission)
+        return self._permissions[permission]
+
+
+def panel_principal():
+    principal = g.get('_panel_principal')
+    if principal is None or principal.user is not fl_current_user._get_current_object():
+        principal = g._panel_principal = Principal(fl_current_user._get_current_object())
+    return principal
+
+
+def rest_principal():
+    principal = g.get('_rest_principal')
+    if principal is None or principal.user is not current_user._get_current_object():
+        principal = g._rest_principal = Principal(current_user._get_current_object())
+    return principal
+
+
+class AccessPolicy(object):
+    """
+    Requirements of a view: a logged in user, staff, admin and a set of
+    permissions. :meth:`compile` turns them into one function of the
+    principal which only runs the checks this policy needs.
+    """
+
+    def __init__(self, login=False, staff=False, admin=False, permissions=()):
+        self.login = login
+        self.staff = staff
+        self.admin = admin
+        self.permissions = tuple(permissions)
+
+    def merge(self, login=False, staff=False, admin=False, permissions=()):
+        return AccessPolicy(
+            login=self.login or login,
+            staff=self.staff or staff,
+            admin=self.admin or admin,
+            permissions=self.permissions + tuple(
+                p for p in permissions if p not in self.permissions),
+        )
+
+    @property
+    def decorators(self):
+        """ Metadata checked by ``Fardel._register_panel`` """
+        return {
+            'login_required': self.login,
+            'staff_required': self.staff,
+            'admin_required': self.admin,
+            'permission_required': self.permissions,
+        }
+
+    def compile(self):
+        checks = []
+        if self.admin:
+            checks.append(lambda principal: principal.is_admin)
+        elif self.staff:
+            checks.append(lambda principal: principal.is_staff or principal.is_admin)
+        for permission in self.permissions:
+            checks.append(lambda principal, permission=permission: principal.can(permission))
+        checks = tuple(checks)
+
+        def check(principal):
+            for allowed in checks:
+                if not allowed(principal):
+                    return False
+            return True
+        return check
+
+
+def login_exempt():
+    return request.method in EXEMPT_METHODS or current_app.config.get('LOGIN_DISABLED')
+
+
+def make_panel_view(func, policy):
+    check = policy.compile()
 
     @wraps(func)
     def wrapper(*args, **kwargs):
-        if fl_current_user and (fl_current_user.is_staff or fl_current_user.is_admin):
+        principal = panel_principal()
+        if policy.login and not principal.is_authenticated and not login_exempt():
+            return current_app.login_manager.unauthorized()
+        if check(principal):
             return func(*args, **kwargs)
         return abort(403)
     return wrapper
 
 
-def staff_required_rest(func):
+def make_rest_view(func, policy):
+    check = policy.compile()
+
     @wraps(func)
     def wrapper(*args, **kwargs):
-        if current_user and (current_user.is_staff or current_user.is_admin):
+        principal = rest_principal()
+        if principal.is_authenticated and check(principal):
             return func(*args, **kwargs)
         return rest_abort(403)
     return wrapper
 
 
-def admin_required(func):
-    if not hasattr(func, 'decorators'):
-        func.decorators = {}
-    func.decorators['admin_required'] = True
-
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        if fl_current_user and fl_current_user.is_authenticated and fl_current_user.is_admin:
-            return func(*args, **kwargs)
-        return abort(403)
+def compile_view(func, make_view, **requirements):
+    """
+    Wraps ``func`` with a single access check. When ``func`` already is such
+    a wrapper of the same kind the requirements are merged into it instead
+    of adding one more layer, so stacked decorators still cost one check.
+    """
+    # functools.wraps copies __access_view__ onto other decorators' wrappers
+    # too, so only merge when ``func`` is the access wrapper itself
+    view = getattr(func, '__access_view__', None)
+    if view is not None and view[0] is make_view and view[3] is func:
+        policy = view[2].merge(**requirements)
+        func = view[1]
+    else:
+        policy = AccessPolicy(**requirements)
+
+    wrapper = make_view(func, policy)
+    wrapper.access_policy = policy
+    wrapper.decorators = dict(getattr(func, 'decorators', {}), **policy.decorators)
+    wrapper.__access_view__ = (make_view, func, policy, wrapper)
     return wrapper
 
 
+def access_required(login=True, staff=False, admin=False, permissions=()):
+    """
+    Declares every requirement of a panel view at once, e.g.
+    ``@access_required(staff=True, permissions=["can_get_users"])``.
+    Anonymous users are sent to the login view unless ``login`` is false,
+    other failures end with 403.
+    """
+    def decorator(func):
+        return compile_view(func, make_panel_view, login=login, staff=staff,
+                            admin=admin, permissions=permissions)
+    return decorator
+
+
+def access_required_rest(staff=False, admin=False, permissions=()):
+    """ :func:`access_required` for resources authenticated with JWT """
+    def decorator(func):
+        return compile_view(func, make_rest_view, staff=staff, admin=admin,
+                            permissions=permissions)
+    return decorator
+
+
+def permission_required(permission):
+    return access_required(login=False, permissions=[permission])
+
+
+def permission_required_rest(permission):
+    return access_required_rest(permissions=[permission])
+
+
+def staff_required(func):
+    return access_required(login=False, staff=True)(func)
+
+
+def staff_required_rest(func):
+    return access_required_rest(staff=True)(func)
+
+
+def admin_required(func):
+    return access_required(login=False, admin=True)(func)
+
+
 def admin_required_rest(func):
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        if current_user and current_user.is_admin:
-            return func(*args, **kwargs)
-        return rest_abort(403)
-    return wrapper
+    return access_required_rest(admin=True)(func)
@@ -0,0 +1,71 @@
+"""
+Pagination helpers for panel list views on large tables.
+"""
+
+import json
+import time
+
+from threading import Thread
+
+from flask import current_app
+
+from fardel.ext import db, cache
+
+__all__ = ["estimated_count", "forget_counts"]
+
+
+def planner_estimate(query):
+    statement = query.statement.compile(
+        dialect=db.engine.dialect, compile_kwargs={"literal_binds": True})
+    connection = db.session.connection().execution_options(no_parameters=True)
+    plan = connection.exec_driver_sql("EXPLAIN (FORMAT JSON) %s" % statement).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+def count_rows(query):
+    """
+    On PostgreSQL large results use the planner's estimate instead of a full
+    count, below ``PANEL_COUNT_EXACT_BELOW`` rows the count is exact.
+    """
+    if db.engine.dialect.name == "postgresql":
+        estimate = planner_estimate(query)
+        if estimate >= current_app.config.get("PANEL_COUNT_EXACT_BELOW", 10000):
+            return estimate
+    return query.order_by(None).count()
+
+
+def refresh_count(app, key, make_query):
+    try:
+        with app.app_context():
+            cache.set(key, (count_rows(make_query()), time.time()), timeout=0)
+    except Exception as err:
+        app.logger.exception("Couldn't refresh count %s: %s" % (key, err))
+
+
+def estimated_count(key, make_query):
+    """
+    Row count of the query built by ``make_query`` served from the cache.
+    After ``PANEL_COUNT_CACHE_TIMEOUT`` seconds the stale count is still
+    returned while a background thread computes a fresh one.
+    """
+    key = "panel:count:%s" % key
+    entry = cache.get(key)
+    if entry is None:
+        count = count_rows(make_query())
+        cache.set(key, (count, time.time()), timeout=0)
+        return count
+
+    count, counted_at = entry
+    if time.time() - counted_at > current_app.config.get("PANEL_COUNT_CACHE_TIMEOUT", 60):
+        # Mark it fresh first so concurrent requests don't start refreshes too
+        cache.set(key, (count, time.time()), timeout=0)
+        app = current_app._get_current_object()
+        Thread(target=refresh_count, args=[app, key, make_query]).start()
+    return count
+
+
+def forget_counts(*keys):
+    """ Drops cached counts after writes which change them """
+    cache.delete_many(*["panel:count:%s" % key for key in keys])
@@ -1,5 +1,22 @@
+import threading
+
+from collections import OrderedDict
+
+from flask import current_app
+from flask_babel import get_locale
 from flask_login import current_user
 
+registry_version = 0
+
+
+def registry_changed():
+    global registry_version
+    registry_version += 1
+
+
+def is_allowed(permission):
+    return permission is None or current_user.can(permission)
+
 
 class Section():
     def __init__(self, title, permission=None):
@@ -8,6 +25,7 @@ class Section():
 
     def add_link(self, link):
         self.links.append(link)
+        registry_changed()
 
     def get_link(self, title):
         for link in self.links:
@@ -21,7 +39,7 @@ class Section():
     def render_links(self):
         return "".join(
             [link.render() for link in self.links
-             if current_user.can(link.permission)]
+             if is_allowed(link.permission)]
         )
 
     def render(self):
@@ -43,6 +61,7 @@ class Link():
 
     def add_child(self, child):
         self.children.append(child)
+        registry_changed()
 
     def fa_chevron_down(self):
         if self.children:
@@ -51,7 +70,7 @@ class Link():
 
     def render_children(self):
         return "".join([child.render() for child in self.children
-                        if current_user.can(child.permission)])
+                        if is_allowed(child.permission)])
 
     def render(self):
         return """<li><a href="{href}"><i class="{icon}"></i> {title} {chevron}</a>
@@ -76,23 +95,50 @@ class ChildLink():
 
 
 class PanelSidebar():
+    """
+    Rendered HTML only depends on the user's permissions, the locale and the
+    registered sections, so it is kept in a bounded LRU keyed by those.
+    """
+
     def __init__(self):
         self.sections = []
+        self._rendered = OrderedDict()
+        self._lock = threading.Lock()
 
     def add_section(self, section):
         self.sections.append(section)
+        registry_changed()
 
     def get_section(self, title):
         for section in self.sections:
             if section.title == title:
                 return section
 
+    def permission_fingerprint(self):
+        if current_user.is_admin:
+            return ("*",)
+        return tuple(sorted(current_user.permission_set))
+
     def render(self):
+        key = (self.permission_fingerprint(), str(get_locale()), registry_version)
+        with self._lock:
+            html = self._rendered.get(key)
+            if html is not None:
+                self._rendered.move_to_end(key)
+                return html
+
+        html = self.render_sections()
+        with self._lock:
+            self._rendered[key] = html
+            while len(self._rendered) > current_app.config.get("PANEL_SIDEBAR_CACHE_SIZE", 128):
+                self._rendered.popitem(last=False)
+        return html
+
+    def render_sections(self):
         sections = []
         for section in self.sections:
-            found = False
             for perm in section.permissions:
-                if current_user.can(perm):
+                if is_allowed(perm):
                     sections.append(section)
                     break
 
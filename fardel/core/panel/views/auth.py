@@ -1,16 +1,42 @@
-import math
-
 from sqlalchemy import or_
 
 from flask import (request, render_template, redirect, url_for,
                    jsonify, abort, current_app, flash)
-from flask_login import current_user, login_required
+from flask_login import current_user
 from flask_babel import gettext, pgettext
 
-from fardel.core.auth.models import User, Group, Permission
+from fardel.core.auth.models import User, Group, Permission, loader_options, parse_ids
+from fardel.core.auth import bulk
+from fardel.core.auth.cache import user_identities, permission_sets
+from fardel.core.auth.email_index import email_index
+from fardel.core.pagination import KeysetPage
 from fardel.ext import db
 
-from .. import mod, staff_required, admin_required, permission_required
+from .. import mod, access_required
+from ..pagination import estimated_count, forget_counts
+
+
+def users_query():
+    return User.query.filter_by(is_staff=False, is_admin=False)
+
+
+def staffs_query():
+    return User.query.filter(or_(User.is_staff == True, User.is_admin == True))
+
+
+def keyset_page(query, column):
+    per_page = max(1, min(request.args.get('per_page', type=int, default=40), 200))
+    return KeysetPage(
+        query, column, per_page,
+        after=request.args.get('after', type=int),
+        before=request.args.get('before', type=int),
+    )
+
+
+@mod.before_app_first_request
+def warm_email_index():
+    if current_app.config["EMAIL_INDEX_WARMUP"]:
+        email_index.rebuild()
 
 
 #########
@@ -18,38 +44,31 @@ from .. import mod, staff_required, admin_required, permission_required
 #########
 
 @mod.route('/auth/users/search/email/')
-@permission_required("can_send_email")
-@staff_required
-@login_required
+@access_required(staff=True, permissions=["can_send_email"])
 def email_users_search():
-    like_query = request.args.get("q")
-    users = User.query.filter(User._email.like("{}%".format(like_query))).all()
+    prefix = request.args.get("q", "").lower()
+    emails = email_index.lookup(prefix, current_app.config["EMAIL_SEARCH_LIMIT"])
     return jsonify({
-        "users": [{"text": u.email} for u in users],
+        "users": [{"text": email} for email in emails],
     })
 
 
 @mod.route('/auth/users/list/')
-@permission_required("can_get_users")
-@staff_required
-@login_required
+@access_required(staff=True, permissions=["can_get_users"])
 def users_list():
-    page = request.args.get('page', type=int, default=1)
-    per_page = request.args.get('per_page', type=int, default=40)
-    query = User.query.filter_by(is_staff=False, is_admin=False)
-    pages = math.ceil(query.count() / per_page)
-    users = query.paginate(
-        page=page, per_page=per_page, error_out=False).items
-    return render_template('auth/users_list.html',
-                           users=users, pages=pages, page=page)
+    pagination = keyset_page(
+        users_query().options(*loader_options("user_groups")), User.id)
+    total = estimated_count("users", users_query)
+    return render_template('auth/users_list.html', users=pagination.items,
+                           pagination=pagination, total=total, scope="users",
+                           groups=Group.catalog())
 
 
 @mod.route('/auth/users/edit/<int:user_id>/', methods=['POST', 'GET'])
-@admin_required
-@staff_required
-@login_required
+@access_required(admin=True)
 def users_edit(user_id):
-    user = User.query.filter_by(id=user_id).first_or_404()
+    user = User.query.options(*loader_options("user_groups")).filter_by(
+        id=user_id).first_or_404()
     if request.method == "POST":
         email = request.form.get('email')
         first_name = request.form.get('first_name')
@@ -65,10 +84,7 @@ def users_edit(user_id):
         user._email = email
         user.first_name = first_name
         user.last_name = last_name
-        user.groups = []
-        for gid in group_ids:
-            group = Group.query.filter_by(id=gid).first()
-            user.groups.append(group)
+        user.set_groups(group_ids)
 
         if password and password != "":
             user.password = password
@@ -77,21 +93,21 @@ def users_edit(user_id):
         user.is_admin = is_admin
         user.is_staff = is_staff
         db.session.commit()
+        user_identities.invalidate(user.id)
+        permission_sets.invalidate(user.id)
 
         if user.is_staff or user.is_admin:
             return redirect(url_for("panel.staffs_list"))
         else:
             return redirect(url_for("panel.users_list"))
 
-    groups = Group.query.all()
     user_group_ids = [g.id for g in user.groups]
-    return render_template('auth/users_form.html', user=user, groups=groups, user_group_ids=user_group_ids)
+    return render_template('auth/users_form.html', user=user, groups=Group.catalog(),
+                           user_group_ids=user_group_ids)
 
 
 @mod.route('/auth/users/create/', methods=['POST', 'GET'])
-@admin_required
-@staff_required
-@login_required
+@access_required(admin=True)
 def users_create():
     if request.method == "POST":
         email = request.form.get('email')
@@ -104,56 +120,99 @@ def users_create():
         password = request.form.get('password')
         confirmed = request.form.get('confirmed', type=bool)
         is_admin = request.form.get('is_admin', type=bool)
+        is_staff = request.form.get('is_staff', type=bool)
         group_ids = request.form.getlist('group_ids')
 
-        for gid in group_ids:
-            group = Group.query.filter_by(id=gid).first()
-            user.groups.append(group)
-
         if not email or not first_name or not last_name:
             flash(gettext('email, first name, last name and password fields can not be empty!'), 'error')
             return redirect(url_for('panel.users_create'))
 
-        user = User(_email=email, first_name=first_name, last_name=last_name, password=password,
-                    confirmed=confirmed, is_admin=is_admin, group_id=group_id)
+        user = User(_email=email, first_name=first_name, last_name=last_name,
+                    confirmed=confirmed, is_admin=is_admin, is_staff=is_staff)
+        if password:
+            user.password = password
 
         db.session.add(user)
+        db.session.flush()
+        user.set_groups(group_ids)
         db.session.commit()
         flash(gettext('user successfully created'), 'success')
         if user.is_staff or user.is_admin:
             return redirect(url_for("panel.staffs_list"))
         else:
             return redirect(url_for("panel.users_list"))
-    groups = Group.query.all()
-    return render_template('auth/users_form.html', groups=groups)
+    return render_template('auth/users_form.html', groups=Group.catalog())
 
 
 @mod.route('/auth/users/delete/<int:user_id>/')
-@admin_required
-@staff_required
-@login_required
+@access_required(admin=True)
 def users_delete(user_id):
     abort(404)
 
+
+USER_UPDATES = {
+    "confirm": {"confirmed": True},
+    "deactivate": {"deleted": True},
+    "activate": {"deleted": False},
+    "grant_staff": {"is_staff": True},
+    "revoke_staff": {"is_staff": False},
+}
+
+BULK_SCOPES = {
+    "users": users_query,
+    "staffs": staffs_query,
+}
+
+
+def bulk_selection(scope):
+    """
+    Users of the list ``scope`` picked in the form, or all of them when
+    ``select_all`` is checked. The current user is never included.
+    """
+    query = BULK_SCOPES[scope]().filter(User.id != current_user.id)
+    if not request.form.get('select_all', type=bool):
+        query = query.filter(User.id.in_(parse_ids(request.form.getlist('user_ids'))))
+    return query
+
+
+@mod.route('/auth/users/bulk/<scope>/', methods=['POST'])
+@access_required(admin=True)
+def users_bulk(scope):
+    if scope not in BULK_SCOPES:
+        abort(404)
+    action = request.form.get('action')
+    query = bulk_selection(scope)
+
+    if action in USER_UPDATES:
+        count = bulk.update_users(query, **USER_UPDATES[action])
+        if action in ("grant_staff", "revoke_staff"):
+            forget_counts("users", "staffs")
+    elif action in ("add_to_group", "remove_from_group"):
+        group = Group.query.filter_by(id=request.form.get('group_id', type=int)).first_or_404()
+        if action == "add_to_group":
+            count = bulk.add_users_to_group(query, group.id)
+        else:
+            count = bulk.remove_users_from_group(query, group.id)
+    else:
+        abort(400)
+
+    flash(gettext('%(count)d users updated', count=count), 'success')
+    return redirect(url_for('panel.%s_list' % scope))
+
 ################
 # STAFFMEMBERS #
 ################
 
 
 @mod.route('/auth/staffs/list/')
-@permission_required("can_get_users")
-@admin_required
-@staff_required
-@login_required
+@access_required(admin=True, permissions=["can_get_users"])
 def staffs_list():
-    page = request.args.get('page', type=int, default=1)
-    per_page = request.args.get('per_page', type=int, default=40)
-    query = User.query.filter(or_(User.is_staff == True, User.is_admin == True))
-    pages = math.ceil(query.count() / per_page)
-    users = query.paginate(
-        page=page, per_page=per_page, error_out=False).items
-    return render_template('auth/users_list.html',
-                           users=users, pages=pages, page=page)
+    pagination = keyset_page(
+        staffs_query().options(*loader_options("user_groups")), User.id)
+    total = estimated_count("staffs", staffs_query)
+    return render_template('auth/users_list.html', users=pagination.items,
+                           pagination=pagination, total=total, scope="staffs",
+                           groups=Group.catalog())
 
 
 ###############
@@ -162,9 +221,7 @@ def staffs_list():
 
 
 @mod.route('/auth/permissions/list/')
-@permission_required('can_get_permissions')
-@staff_required
-@login_required
+@access_required(staff=True, permissions=["can_get_permissions"])
 def permissions_get():
     return jsonify({
         'permissions': [obj.dict() for obj in
@@ -177,65 +234,50 @@ def permissions_get():
 
 
 @mod.route('/auth/groups/list/')
-@permission_required('can_get_groups')
-@staff_required
-@login_required
+@access_required(staff=True, permissions=["can_get_groups"])
 def groups_list():
-    page = request.args.get('page', type=int, default=1)
-    per_page = request.args.get('per_page', type=int, default=40)
-    query = Group.query
-    pages = math.ceil(query.count() / per_page)
-    groups = query.paginate(
-        page=page, per_page=per_page, error_out=False).items
-    return render_template('auth/groups_list.html',
-                           groups=groups, pages=pages, page=page)
+    pagination = keyset_page(
+        Group.query.options(*loader_options("group_permissions")), Group.id)
+    total = estimated_count("groups", lambda: Group.query)
+    return render_template('auth/groups_list.html', groups=pagination.items,
+                           pagination=pagination, total=total)
 
 
 @mod.route('/auth/group/create/', methods=["POST", "GET"])
-@admin_required
-@staff_required
-@login_required
+@access_required(admin=True)
 def groups_create():
-    permissions = Permission.query.all()
     if request.method == "POST":
         name = request.form.get("name")
-        permissions = request.form.getlist("permissions")
+        permission_ids = request.form.getlist("permissions")
 
         group = Group(name=name)
-
-        for pid in permissions:
-            permission = Permission.query.filter_by(id=pid).first()
-            group.permissions.append(permission)
-
         db.session.add(group)
+        db.session.flush()
+        group.set_permissions(permission_ids)
         db.session.commit()
+        permission_sets.bump()
         flash(gettext("Group created successfully"))
         return redirect(url_for("panel.groups_list"))
 
-    return render_template("auth/groups_form.html", permissions=permissions)
+    return render_template("auth/groups_form.html", permissions=Permission.catalog())
 
 
 @mod.route('/auth/group/edit/<int:group_id>/', methods=["POST", "GET"])
-@admin_required
-@staff_required
-@login_required
+@access_required(admin=True)
 def groups_edit(group_id):
-    group = Group.query.filter_by(id=group_id).first_or_404()
+    group = Group.query.options(*loader_options("group_permissions")).filter_by(
+        id=group_id).first_or_404()
     if request.method == "POST":
         name = request.form.get("name")
-        permissions = request.form.getlist("permissions")
+        permission_ids = request.form.getlist("permissions")
 
         group.name = name
-        group.permissions = []
-        for pid in permissions:
-            permission = Permission.query.filter_by(id=pid).first()
-            group.permissions.append(permission)
-
-        db.session.add(group)
+        group.set_permissions(permission_ids)
         db.session.commit()
+        permission_sets.bump()
         flash(gettext("Group editted successfully"))
         return redirect(url_for("panel.groups_list"))
 
-    permissions = Permission.query.all()
     group_permission_ids = [p.id for p in group.permissions]
-    return render_template("auth/groups_form.html", permissions=permissions, group=group, group_permission_ids=group_permission_ids)
+    return render_template("auth/groups_form.html", permissions=Permission.catalog(), group=group,
+                           group_permission_ids=group_permission_ids)
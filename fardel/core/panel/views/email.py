@@ -1,17 +1,15 @@
 from flask import (request, render_template, redirect, url_for,
                    jsonify, abort, current_app, flash)
-from flask_login import current_user, login_required
+from flask_login import current_user
 from flask_babel import gettext, pgettext
 
 from fardel.core import email as email_pkg
 
-from .. import mod, staff_required, permission_required
+from .. import mod, access_required
 
 
 @mod.route('/communication/email/send/', methods=["GET", "POST"])
-@permission_required("can_send_email")
-@staff_required
-@login_required
+@access_required(staff=True, permissions=["can_send_email"])
 def email_send():
     if request.method == "POST":
         sender = request.form.get("sender")
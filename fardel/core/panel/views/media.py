@@ -24,14 +24,15 @@ from flask_jwt_extended import jwt_required
 from fardel.core.rest import create_api, abort, Resource
 from fardel.ext import db
 
-from .. import mod, staff_required_rest, permission_required
+from .. import mod, access_required_rest
 from ...base import BaseResource
 from ...media.models import File
 
 
 panel_media_api = create_api(mod)
 
-panel_decorators = [staff_required_rest, jwt_required]
+def panel_decorators(permission):
+    return [access_required_rest(staff=True, permissions=[permission]), jwt_required]
 
 def rest_resource(resource_cls):
     """ Decorator for adding resources to Api App """
@@ -53,9 +54,9 @@ class FileApi(Resource):
     """
     endpoints = ['/files/']
     method_decorators = {
-        'get': [permission_required('can_see_directory')] + panel_decorators,
-        'post': [permission_required('can_create_files')] + panel_decorators,
-        'delete': [permission_required('can_delete_files')] + panel_decorators,
+        'get': panel_decorators('can_see_directory'),
+        'post': panel_decorators('can_create_files'),
+        'delete': panel_decorators('can_delete_files'),
     }
     def get(self):
         """
@@ -131,9 +132,9 @@ class ImageAlbumApi(BaseResource):
     """
     endpoints = ['/image_album/']
     method_decorators = {
-        'get': [permission_required('can_see_directory')] + panel_decorators,
-        'post': [permission_required('can_create_files')] + panel_decorators,
-        'delete': [permission_required('can_delete_files')] + panel_decorators,
+        'get': panel_decorators('can_see_directory'),
+        'post': panel_decorators('can_create_files'),
+        'delete': panel_decorators('can_delete_files'),
     }
     def get(self):
         """ Directory listing of upload folder """
@@ -0,0 +1,73 @@
+"""
+Cache of the per-model results of ``/api/search/``.
+"""
+
+import threading
+
+from flask import current_app
+from flask_babel import get_locale
+
+from fardel.ext import cache
+
+from .utils import fingerprint
+from .versions import model_versions
+
+__all__ = ["SearchCache", "search_cache", "normalize_query"]
+
+
+def normalize_query(search_string):
+    return " ".join(search_string.split()).casefold()
+
+
+class SearchCache(object):
+    """
+    Results are kept in the ``cache`` backend for ``SEARCH_CACHE_TIMEOUT``
+    seconds, ``0`` disables caching. Keys include the model's version, so
+    any insert, update or delete of the model's rows invalidates its
+    entries. Hit and miss counters are kept per worker.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @property
+    def timeout(self):
+        return current_app.config.get("SEARCH_CACHE_TIMEOUT", 60)
+
+    def keys(self, models, search_string, page, per_page):
+        versions = model_versions.versions(*models)
+        parts = (search_string, page, per_page, str(get_locale()),
+                 current_app.config["SEARCH_BACKEND"])
+        return {model: "search:%s:%s" % (model.__tablename__, fingerprint(version, *parts))
+                for model, version in zip(models, versions)}
+
+    def get_many(self, keys):
+        """ Cached results of the models in ``keys``, by model """
+        if not self.timeout or not keys:
+            return {}
+        models = list(keys)
+        found = {model: result for model, result
+                 in zip(models, cache.get_many(*[keys[model] for model in models]))
+                 if result is not None}
+        with self._lock:
+            self.hits += len(found)
+            self.misses += len(models) - len(found)
+        return found
+
+    def set_many(self, keys, results):
+        if self.timeout and results:
+            cache.set_many({keys[model]: result for model, result in results.items()},
+                           timeout=self.timeout)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+search_cache = SearchCache()
@@ -1,12 +1,13 @@
 from fardel.ext import db
 
+from .serializers import Serializer
+
 
 class SeoModel(object):
 	seo_title = db.Column(db.String(70))
 	seo_description = db.Column(db.String(300))
 
+	seo_serializer = Serializer('seo_title', 'seo_description')
+
 	def seo_dict(self):
-		return {
-			'seo_title': self.seo_title,
-			'seo_description': self.seo_description
-		}
\ No newline at end of file
+		return self.seo_serializer.dump(self)
\ No newline at end of file
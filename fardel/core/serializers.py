@@ -0,0 +1,132 @@
+"""
+Declarative serializers turning columns of a model into dicts.
+
+A model declares the columns it exposes once::
+
+    class User(db.Model):
+        serializer = Serializer("id", "first_name", ("email", "_email"))
+
+        def dict(self):
+            return self.serializer.dump(self)
+
+Fields are column attribute names, or ``(key, attribute)`` pairs when the
+key differs. The field list is resolved once per model into two functions,
+one for objects and one for the rows of a select of
+:attr:`BoundSerializer.columns`, so list endpoints can skip creating ORM
+objects altogether. These are used instead of ``dict()`` only while no
+subclass of the declaring model overrides ``dict()``, see
+:func:`get_serializer`.
+"""
+
+import datetime
+
+from sqlalchemy import inspect
+
+from .utils import convert_timestamp
+
+__all__ = ["Serializer", "get_serializer", "dump_query", "dump_ids"]
+
+DATE_TYPES = (datetime.date, datetime.datetime)
+
+
+def convert_date(value):
+    return convert_timestamp(value) if value is not None else None
+
+
+class BoundSerializer(object):
+    """ A :class:`Serializer` resolved for one model """
+
+    def __init__(self, model, fields):
+        self.model = model
+        self.fields = fields
+        mapper_columns = inspect(model).columns
+        self.columns = [getattr(model, attribute) for _, attribute in fields]
+        self.attributes = {attribute for _, attribute in fields}
+
+        keys = [key for key, _ in fields]
+        dates = []
+        for key, attribute in fields:
+            try:
+                if mapper_columns[attribute].type.python_type in DATE_TYPES:
+                    dates.append(key)
+            except NotImplementedError:
+                pass
+
+        def dump(obj):
+            values = {key: getattr(obj, attribute) for key, attribute in fields}
+            for key in dates:
+                values[key] = convert_date(values[key])
+            return values
+
+        def dump_row(row):
+            # Columns selected after the serialized ones are left out by zip
+            values = dict(zip(keys, row))
+            for key in dates:
+                values[key] = convert_date(values[key])
+            return values
+
+        self.dump = dump
+        self.dump_row = dump_row
+
+    def select(self, query, *extra):
+        """ ``query`` selecting only the serialized columns, then ``extra`` """
+        extra = [column for column in extra if column.key not in self.attributes]
+        return query.with_entities(*self.columns, *extra)
+
+    def load(self, query):
+        return [self.dump_row(row) for row in self.select(query)]
+
+
+class Serializer(object):
+    """
+    Descriptor declaring the exposed columns, resolved for the model it's
+    accessed from the first time, which also works on mixins.
+    """
+
+    def __init__(self, *fields):
+        self.fields = [field if isinstance(field, tuple) else (field, field) for field in fields]
+        self._bound = {}
+
+    def __get__(self, obj, owner):
+        bound = self._bound.get(owner)
+        if bound is None:
+            bound = self._bound[owner] = BoundSerializer(owner, self.fields)
+        return bound
+
+
+def get_serializer(model):
+    """
+    The ``serializer`` of ``model``, or ``None`` when it has none or a class
+    overrides ``dict()`` after declaring it, so the customized output isn't
+    dropped for plain rows.
+    """
+    for cls in model.__mro__:
+        if "serializer" in vars(cls):
+            return getattr(model, "serializer")
+        if "dict" in vars(cls):
+            return None
+    return None
+
+
+def dump_query(model, query):
+    """
+    Dicts of what ``query`` selects from ``model``, loaded as plain rows when
+    the model has a ``serializer``, otherwise with ``dict()`` of each object.
+    """
+    serializer = get_serializer(model)
+    if serializer is None:
+        return [obj.dict() for obj in query]
+    return serializer.load(query)
+
+
+def dump_ids(model, ids):
+    """ Dicts of the objects with ``ids``, in the same order """
+    if not ids:
+        return []
+    query = model.query.filter(model.id.in_(ids))
+    serializer = get_serializer(model)
+    if serializer is None:
+        dumped = {obj.id: obj.dict() for obj in query}
+    else:
+        dumped = {row.id: serializer.dump_row(row) for row in serializer.select(query, model.id)}
+    return [dumped[i] for i in ids if i in dumped]
@@ -1,25 +1,98 @@
+import json
 import time
 import string
 import random
+import hashlib
+
+from functools import wraps
 
 from flask import request
+from flask_babel import get_locale
+from flask_jwt_extended import verify_jwt_in_request, get_current_user, get_jwt_identity
+from werkzeug.http import unquote_etag
+
+from fardel.ext import cache
+
+from .versions import model_versions
 
 
 def convert_timestamp(dt):
     return time.mktime(dt.timetuple())
 
 
-def make_cache_key(*args, **kwargs):
-    path = request.path
-    args = str(hash(frozenset(request.args.items())))
-    # lang = get_locale()
-    return (path + args).encode('utf-8')
+def fingerprint(*parts):
+    """ Stable hash of JSON serializable ``parts``, the same in every process """
+    dump = json.dumps(parts, sort_keys=True, default=str, separators=(",", ":"))
+    return hashlib.sha1(dump.encode("utf8")).hexdigest()
+
+
+def identity_fingerprint():
+    """ The JWT identity of the request and the permissions it holds """
+    verify_jwt_in_request(optional=True)
+    user = get_current_user()
+    if user is None:
+        return None
+    return [get_jwt_identity(), user.is_admin, sorted(user.permission_set)]
+
+
+def make_cache_key(*args, identity=False, versions=(), **kwargs):
+    """
+    Key of the current request built from its path, its sorted query
+    arguments and locale. With ``identity`` the user and their permissions
+    are part of the key, ``versions`` are the model versions it depends on.
+    """
+    parts = [
+        sorted(request.args.items(multi=True)),
+        str(get_locale()),
+        identity_fingerprint() if identity else None,
+        list(versions),
+    ]
+    return "view:%s:%s" % (request.path, fingerprint(*parts))
+
+
+def is_fresh(rv):
+    """ Whether a cached ``(payload, status, headers)`` matches If-None-Match """
+    etag = rv[2].get("ETag") if isinstance(rv, tuple) and len(rv) == 3 else None
+    return etag is not None and request.if_none_match.contains_weak(unquote_etag(etag)[0])
+
+
+def cache_get_key(resource_cls=None, timeout=None, identity=True):
+    """
+    Decorator attaching :func:`make_cache_key` to a resource's ``get``.
+    Responses are only cached when a ``timeout`` is given, e.g.
+    ``@cache_get_key(timeout=60)``. Keys then include the user and their
+    permissions unless ``identity=False`` is passed, which is only safe for
+    resources answering every user the same. Keys also include the versions
+    of the resource's ``tracked_models`` so writes to those models, e.g.
+    through ``PostBaseResource`` and ``DeleteBaseResource``, invalidate
+    exactly the responses built from them.
+    """
+    def decorator(resource_cls):
+        get = resource_cls.get
+        if timeout is None:
+            get.make_cache_key = make_cache_key
+            return resource_cls
+
+        @wraps(get)
+        def cached_get(self, *args, **kwargs):
+            versions = model_versions.versions(*getattr(self, "tracked_models", ()))
+            key = make_cache_key(*args, identity=identity, versions=versions, **kwargs)
+            rv = cache.get(key)
+            if rv is None:
+                rv = get(self, *args, **kwargs)
+                if isinstance(rv, dict) or (isinstance(rv, tuple) and rv[1] == 200):
+                    cache.set(key, rv, timeout=timeout)
+            elif is_fresh(rv):
+                return self.not_modified(unquote_etag(rv[2]["ETag"])[0])
+            return rv
 
+        cached_get.make_cache_key = make_cache_key
+        resource_cls.get = cached_get
+        return resource_cls
 
-def cache_get_key(resource_cls):
-    """ Decorator for adding resources to Api App """
-    resource_cls.get.make_cache_key = make_cache_key
-    return resource_cls
+    if resource_cls is not None:
+        return decorator(resource_cls)
+    return decorator
 
 
 def random_string(length=6):
@@ -0,0 +1,105 @@
+"""
+Versions of models kept in the cache backend. A model's version is
+replaced after every commit which wrote its rows, so anything derived from
+a table can be checked for freshness with one cache lookup.
+"""
+
+import uuid
+
+from sqlalchemy import event
+from sqlalchemy.orm import Mapper, Session
+from flask import current_app
+from flask_caching.backends import SimpleCache, NullCache
+
+from fardel.ext import db, cache
+
+__all__ = ["ModelVersions", "model_versions"]
+
+
+class ModelVersions(object):
+    """
+    Writes through the ORM, including ``Query.update`` and
+    ``Query.delete``, are tracked automatically. Statements executed on
+    tables directly must call :meth:`touch` before the commit, or
+    :meth:`bump` after it. Versions expire after ``MODEL_VERSION_TIMEOUT``
+    seconds, which bounds how long writes nobody bumped for, like raw SQL,
+    go unnoticed.
+
+    Other workers only see a bump when the cache backend is shared between
+    processes, see :meth:`is_shared`.
+    """
+
+    def _key(self, model):
+        return "model:version:%s" % model.__tablename__
+
+    @property
+    def timeout(self):
+        return current_app.config.get("MODEL_VERSION_TIMEOUT", 300)
+
+    def is_shared(self):
+        """
+        Whether every process sees the same versions, ``MODEL_VERSIONS_SHARED``
+        overrides the guess made from the cache backend. Per-process backends
+        like ``simple`` never see the bumps of other workers.
+        """
+        shared = current_app.config.get("MODEL_VERSIONS_SHARED")
+        if shared is None:
+            shared = not isinstance(cache.cache, (SimpleCache, NullCache))
+        return shared
+
+    def versions(self, *models):
+        keys = [self._key(model) for model in models]
+        versions = cache.get_many(*keys)
+        missing = [model for model, version in zip(models, versions) if version is None]
+        if missing:
+            bumped = self.bump(*missing)
+            versions = [version or bumped[model] for model, version in zip(models, versions)]
+        return versions
+
+    def version(self, model):
+        return self.versions(model)[0]
+
+    def bump(self, *models):
+        versions = {model: uuid.uuid4().hex for model in models}
+        cache.set_many({self._key(model): version for model, version in versions.items()},
+                       timeout=self.timeout)
+        return versions
+
+    def touch(self, *models, session=None):
+        """ Bumps ``models`` once the current transaction commits """
+        pending_models(session or db.session()).update(models)
+
+
+model_versions = ModelVersions()
+
+
+def pending_models(session):
+    return session.info.setdefault("model_versions", set())
+
+
+@event.listens_for(Mapper, "after_insert")
+@event.listens_for(Mapper, "after_update")
+@event.listens_for(Mapper, "after_delete")
+def model_written(mapper, connection, target):
+    session = Session.object_session(target)
+    if session is not None:
+        pending_models(session).add(mapper.class_)
+
+
+@event.listens_for(Session, "after_bulk_update")
+@event.listens_for(Session, "after_bulk_delete")
+def models_written(context):
+    pending_models(context.session).add(context.mapper.class_)
+
+
+@event.listens_for(Session, "after_commit")
+def bump_written_models(session):
+    models = session.info.pop("model_versions", None)
+    if models:
+        model_versions.bump(*models)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def discard_written_models(session, previous_transaction):
+    if previous_transaction.parent is None:
+        session.info.pop("model_versions", None)
@@ -1,13 +1,15 @@
 import click
 import os
 
-from flask.cli import FlaskGroup
+from flask.cli import FlaskGroup, with_appcontext
 from flask_migrate import Migrate
 
 from fardel import Fardel
 from fardel.ext import db
 
-from fardel.core.auth.models import User
+from fardel.core.auth.models import User, RevokedToken, VerificationToken, sync_permissions
+from fardel.core.auth import bulk
+from fardel.core import indexer, fulltext
 
 
 def create_admin(email, password):
@@ -17,13 +19,112 @@ def create_admin(email, password):
     print("Successfull created an admin.")
 
 
+@click.command("create-admin")
+@click.argument("email")
+@click.password_option()
+@with_appcontext
+def create_admin_command(email, password):
+    """ Creates an admin user """
+    create_admin(email, password)
+
+
+@click.command("purge-revoked-tokens")
+@click.option("--batch-size", default=1000, show_default=True,
+              help="Number of rows deleted per transaction.")
+@with_appcontext
+def purge_revoked_tokens_command(batch_size):
+    """ Deletes revoked tokens which are already expired """
+    purged = RevokedToken.purge_expired(batch_size=batch_size)
+    click.echo("Purged %d expired revoked tokens." % purged)
+
+
+@click.command("purge-verification-tokens")
+@click.option("--batch-size", default=1000, show_default=True,
+              help="Number of rows deleted per transaction.")
+@with_appcontext
+def purge_verification_tokens_command(batch_size):
+    """ Deletes verification tokens which are already expired """
+    purged = VerificationToken.purge_expired(batch_size=batch_size)
+    click.echo("Purged %d expired verification tokens." % purged)
+
+
+@click.command("sync-permissions")
+@with_appcontext
+def sync_permissions_command():
+    """ Creates the permissions of core and active apps """
+    created = sync_permissions()
+    click.echo("Created %d permissions." % len(created))
+
+
+@click.command("import-users")
+@click.argument("file", type=click.File("r", encoding="utf-8"))
+@click.option("--format", "file_format", type=click.Choice(["csv", "ndjson"]),
+              help="Format of the file, guessed from its extension by default.")
+@click.option("--batch-size", default=1000, show_default=True,
+              help="Number of users inserted per statement.")
+@with_appcontext
+def import_users_command(file, file_format, batch_size):
+    """ Imports users from a CSV or NDJSON file, existing emails and usernames are skipped """
+    if file_format is None:
+        file_format = "ndjson" if file.name.endswith((".ndjson", ".jsonl")) else "csv"
+    if file_format == "csv":
+        records = bulk.read_users_csv(file)
+    else:
+        records = bulk.read_users_ndjson(file)
+    inserted = bulk.import_users(records, batch_size=batch_size)
+    click.echo("Imported %d users." % inserted)
+
+
+@click.command("seed-users")
+@click.argument("count", type=int)
+@click.option("--password", default=None, help="Password shared by all generated users.")
+@click.option("--batch-size", default=1000, show_default=True,
+              help="Number of users inserted per statement.")
+@with_appcontext
+def seed_users_command(count, password, batch_size):
+    """ Generates COUNT synthetic users """
+    inserted = bulk.import_users(bulk.generate_users(count, password), batch_size=batch_size)
+    click.echo("Created %d users." % inserted)
+
+
+@click.command("reindex")
+@click.option("--batch-size", default=1000, show_default=True,
+              help="Number of rows read from the database at once.")
+@with_appcontext
+def reindex_command(batch_size):
+    """ Rebuilds the search index of every model with search_fields """
+    for model in indexer.reindex(batch_size=batch_size):
+        click.echo("Indexed %s." % model.__name__)
+
+
+@click.command("fulltext-setup")
+@with_appcontext
+def fulltext_setup_command():
+    """ Adds the tsvector column and GIN index of every model with search_fields """
+    for model in indexer.searchable_models():
+        fulltext.add_search_vector(model)
+        click.echo("Added search vector to %s." % model.__tablename__)
+    db.session.commit()
+
+
 class FardelManager:
+    commands = [
+        create_admin_command,
+        purge_revoked_tokens_command,
+        purge_verification_tokens_command,
+        sync_permissions_command,
+        import_users_command,
+        seed_users_command,
+        reindex_command,
+        fulltext_setup_command,
+    ]
+
     def __init__(self, fardel: Fardel):
         self.fardel = fardel
 
-        Migrate(fardel.app, db)
+        Migrate(fardel.app, db, include_object=fulltext.include_object)
 
-        # self.register_commands()
+        self.register_commands()
 
         self.cli = FlaskGroup(
             help="A general utility script for Fardel applications.",
@@ -34,7 +135,8 @@ class FardelManager:
         return self.fardel.app
 
     def register_commands(self):
-        self.fardel.app.cli.command(create_admin)
+        for command in self.commands:
+            self.fardel.app.cli.add_command(command)
 
     def run(self):
         self.cli.main()
@@ -1 +1,5 @@
-from .auth import AuthTestCase
\ No newline at end of file
+from .auth import AuthTestCase
+from .resources import GetBaseResourceTestCase
+from .search import IndexSearchTestCase
+from .hashing import PasswordHasherTestCase
+from .bulk import BulkUsersTestCase
@@ -1,5 +1,13 @@
+from sqlalchemy import event
+
 from fardel.ext import db
-from fardel.core.auth.models import User
+from fardel.core.auth.models import (
+    User, Group, Permission, RevokedToken, setup_permissions, sync_permissions,
+    upsert_permissions_statement, loader_options,
+)
+from fardel.ext import cache
+from fardel.core.auth.cache import revoked_tokens, RevokedTokenCache, user_identities
+from fardel.core.auth.email_index import email_index, EmailPrefixIndex
 
 from .base import BaseTestCase
 
@@ -70,6 +78,109 @@ class AuthTestCase(BaseTestCase):
         self.assertEqual(json_data['message'], "Token has been revoked")
         self.assertEqual(401, response.status_code)
 
+    def test_revoked_token_cache(self):
+        self.register()
+        response, json_data = self.profile()
+        self.assertEqual(200, response.status_code)
+
+        hits = revoked_tokens.hits
+        self.post('/api/auth/logout/')
+        response, json_data = self.profile()
+        self.assertEqual(json_data['message'], "Token has been revoked")
+        self.assertEqual(401, response.status_code)
+        self.assertEqual(hits + 1, revoked_tokens.hits)
+
+    def test_revoked_token_cache_cold(self):
+        with self.app.app_context():
+            # Revoking before the first request, e.g. from a script
+            tokens = RevokedTokenCache()
+            tokens.add('cold')
+            self.assertTrue(tokens.is_revoked('cold'))
+
+    def test_revoked_token_other_worker(self):
+        with self.app.app_context():
+            # A second worker sharing the cache backend
+            other = RevokedTokenCache()
+            other.warm()
+            self.assertFalse(other.is_revoked('elsewhere'))
+            RevokedToken(jti='elsewhere').add()
+            self.assertTrue(other.is_revoked('elsewhere'))
+            RevokedToken.query.filter_by(jti='elsewhere').delete()
+            db.session.commit()
+
+    def test_revoked_token_sync(self):
+        with self.app.app_context():
+            tokens = RevokedTokenCache()
+            tokens.warm()
+            # The later id commits first, as concurrent logouts may
+            last_id = tokens._last_id
+            db.session.add(RevokedToken(id=last_id + 2, jti='late'))
+            db.session.commit()
+            tokens._sync()
+            self.assertTrue(tokens.is_revoked('late'))
+
+            db.session.add(RevokedToken(id=last_id + 1, jti='early'))
+            db.session.commit()
+            tokens._sync()
+            self.assertTrue(tokens.is_revoked('early'))
+
+            RevokedToken.query.filter(RevokedToken.jti.in_(['late', 'early'])).delete(
+                synchronize_session=False)
+            db.session.commit()
+
+    def test_sync_permissions(self):
+        with self.app.app_context():
+            Permission.query.filter(Permission.code_name.like('can_sync_%')).delete(
+                synchronize_session=False)
+            self.assertEqual(['can_sync_test'], sync_permissions({'can_sync_test': 'Sync'}))
+            self.assertEqual([], sync_permissions({'can_sync_test': 'Renamed'}))
+            # Another worker inserting the same permission meanwhile
+            db.session.execute(upsert_permissions_statement(),
+                               [{'code_name': 'can_sync_test', 'name': 'Again'}])
+            db.session.commit()
+            permissions = Permission.query.filter_by(code_name='can_sync_test').all()
+            self.assertEqual(['Again'], [p.name for p in permissions])
+            Permission.query.filter_by(code_name='can_sync_test').delete()
+            db.session.commit()
+
+    def test_email_index(self):
+        with self.app.app_context():
+            email_index.build()
+            db.session.add(User(email='index@test.com'))
+            db.session.commit()
+            self.assertFalse(email_index.is_stale())
+            self.assertEqual(['index@test.com'], email_index.lookup('index', 10))
+
+            user = User.query.filter_by(_email='index@test.com').one()
+            user.email = 'index2@test.com'
+            db.session.commit()
+            self.assertEqual(['index2@test.com'], email_index.lookup('index', 10))
+
+            db.session.delete(user)
+            db.session.commit()
+            self.assertEqual([], email_index.lookup('index', 10))
+
+            # Written by another worker: stale, answered from the database
+            db.session.execute(User.__table__.insert().values(_email='index3@test.com'))
+            db.session.commit()
+            email_index.bump()
+            self.assertEqual(['index3@test.com'], email_index.lookup('index', 10))
+
+    def test_email_index_changes(self):
+        with self.app.app_context():
+            # A second worker sharing the cache backend
+            other = EmailPrefixIndex()
+            other.build()
+            built_at = other._built_at
+            db.session.add(User(email='delta@test.com'))
+            db.session.commit()
+            self.assertEqual(['delta@test.com'], other.lookup('delta', 10))
+            self.assertEqual(built_at, other._built_at)
+            self.assertFalse(other._building)
+
+            email_index.bump()
+            self.assertFalse(other.catch_up())
+
     def test_profile(self):
         json_data, _ = self.register()
         self.assertEqual(json_data.get('message'), "Successfully registered")
@@ -78,11 +189,111 @@ class AuthTestCase(BaseTestCase):
         self.assertIsNotNone(json_data['user'])
         self.assertEqual(200, response.status_code)
 
+        response = self.client.get('/api/auth/profile/', headers={
+            'Authorization': 'Bearer %s' % self.access_token,
+            'If-None-Match': response.headers['ETag'],
+        })
+        self.assertEqual(304, response.status_code)
+
         response = self.put('/api/auth/profile/', data={'first_name': 'test2'})
         json_data = self.get_json(response.data)
         self.assertEqual(json_data['user']['first_name'], 'test2')
         self.assertEqual(200, response.status_code)
 
+    def test_identity_cache(self):
+        self.register()
+        self.profile()
+        hits = user_identities.hits
+        response, json_data = self.profile()
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(hits + 1, user_identities.hits)
+
+        with self.app.app_context():
+            user_id = User.query.filter_by(_email=self.email).one().id
+            _, columns = cache.get(user_identities._id_key(user_id))
+            self.assertEqual(self.email, columns['_email'])
+            self.assertNotIn('password_hash', columns)
+
+            # The hash is loaded from the database when it's needed
+            hits = user_identities.hits
+            user = user_identities.by_id(user_id)
+            self.assertEqual(hits + 1, user_identities.hits)
+            self.assertTrue(user.check_password(self.password))
+
+        self.put('/api/auth/profile/', data={'first_name': 'cached'})
+        response, json_data = self.profile()
+        self.assertEqual('cached', json_data['user']['first_name'])
+
+    def test_user_can(self):
+        with self.app.app_context():
+            setup_permissions()
+            u = User(email=self.email, password=self.password)
+            g = Group(name="Test")
+            g.add_permission('can_get_users')
+            u.groups.append(g)
+            db.session.add(u)
+            db.session.commit()
+            self.assertTrue(u.can('can_get_users'))
+            self.assertFalse(u.can('can_get_groups'))
+
+            u.set_admin()
+            self.assertTrue(u.can('can_get_groups'))
+
+            u.groups.remove(g)
+            db.session.delete(g)
+            db.session.commit()
+
+    def test_loader_options(self):
+        with self.app.app_context():
+            setup_permissions()
+            u = User(email=self.email, password=self.password)
+            for name in ('a', 'b', 'c'):
+                g = Group(name=name)
+                g.add_permission('can_get_users')
+                u.groups.append(g)
+            db.session.add(u)
+            db.session.commit()
+
+            statements = []
+
+            def count(conn, cursor, statement, *args):
+                statements.append(statement)
+
+            expected = {'selectin': 3, 'joined': 1, 'lazy': 5}
+            event.listen(db.engine, 'before_cursor_execute', count)
+            try:
+                for strategy, queries in expected.items():
+                    self.app.config['AUTH_LOADER_STRATEGIES'] = {'user_access': strategy}
+                    db.session.expunge_all()
+                    del statements[:]
+                    user = User.query.options(*loader_options('user_access')).filter_by(
+                        _email=self.email).scalar()
+                    access = user.access_dict()
+                    self.assertEqual(queries, len(statements), strategy)
+                    self.assertEqual(['a', 'b', 'c'], sorted(g['name'] for g in access['groups']))
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', count)
+
+            groups = list(user.groups)
+            user.groups = []
+            for g in groups:
+                db.session.delete(g)
+            db.session.commit()
+
+    def test_verification_token(self):
+        with self.app.app_context():
+            u = User(email=self.email, password=self.password)
+            db.session.add(u)
+            db.session.commit()
+
+            token = u.generate_token('email_confirm')
+            self.assertEqual(1, u.count_active_tokens('email_confirm'))
+            self.assertFalse(u.confirm_token(token, 'password_reset'))
+            self.assertTrue(u.confirm_email_with_token(token))
+            self.assertTrue(u.confirmed)
+            self.assertFalse(u.confirm_token(token, 'email_confirm'))
+            self.assertEqual(0, u.count_active_tokens('email_confirm'))
+
     def test_refresh_token(self):
         json_data, response = self.register()
         self.assertEqual(json_data.get('message'), "Successfully registered")
@@ -145,6 +145,6 @@ class BasePanelTestCase(BaseTestCase):
 
     def set_staff_to_group(self, g):
         with self.app.app_context():
-            u = User.query.filter_by(email=self.email).first()
-            u.group = g
+            u = User.query.filter_by(_email=self.email).first()
+            u.groups.append(db.session.merge(g))
             db.session.commit()
@@ -0,0 +1,51 @@
+import unittest
+
+from fardel.ext import db
+from fardel.core.auth import bulk
+from fardel.core.auth.models import User
+from .base import BaseTestCase
+
+try:
+    import mimesis
+except ImportError:
+    mimesis = None
+
+
+class BulkUsersTestCase(BaseTestCase):
+    def tearDown(self):
+        with self.app.app_context():
+            User.query.delete()
+            db.session.commit()
+
+    def test_import(self):
+        records = [
+            {'email': 'a@test.com', 'username': 'a', 'password_hash': 'x'},
+            {'email': 'A@test.com ', 'username': 'other'},
+            {'email': 'b@test.com', 'username': 'a'},
+            {'email': 'c@test.com', 'is_staff': 'yes'},
+            {'first_name': 'no email'},
+        ]
+        with self.app.app_context():
+            self.assertEqual(2, bulk.import_users(records, batch_size=2))
+            users = {u.email: u for u in User.query}
+            self.assertEqual({'a@test.com', 'c@test.com'}, set(users))
+            self.assertTrue(users['c@test.com'].is_staff)
+
+            self.assertEqual(0, bulk.import_users(records))
+            self.assertEqual(2, User.query.count())
+
+    def test_without_conflicts(self):
+        with self.app.app_context():
+            db.session.add(User(email='a@test.com', username='a'))
+            db.session.commit()
+            rows = bulk.prepare_rows([
+                {'email': 'a@test.com'}, {'email': 'b@test.com', 'username': 'a'},
+                {'email': 'c@test.com', 'username': 'c'}, {'email': 'd@test.com', 'username': 'c'},
+            ])
+            self.assertEqual(['c@test.com'], [row['_email'] for row in bulk.without_conflicts(rows)])
+
+    @unittest.skipIf(mimesis is None, "mimesis isn't installed")
+    def test_generate(self):
+        with self.app.app_context():
+            self.assertEqual(5, bulk.import_users(bulk.generate_users(5), batch_size=2))
+            self.assertEqual(5, User.query.count())
@@ -0,0 +1,72 @@
+import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from fardel.ext import db
+from fardel.core.auth.models import User
+from fardel.core.auth.hashing import PasswordHasher, HashingOverloaded, password_hasher, get_rounds
+from .base import BaseTestCase
+
+
+class PasswordHasherTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app.config["BCRYPT_LOG_ROUNDS"] = 4
+
+    def tearDown(self):
+        with self.app.app_context():
+            User.query.delete()
+            db.session.commit()
+
+    def saturate(self, hasher):
+        """ Makes ``hasher`` use a pool whose only slot is taken """
+        self.app.config["PASSWORD_HASHING_WORKERS"] = 1
+        hasher._executor = ThreadPoolExecutor(1)
+        hasher._slots = threading.BoundedSemaphore(1)
+        hasher._pid = os.getpid()
+        hasher._slots.acquire()
+
+    def test_inline(self):
+        self.app.config["PASSWORD_HASHING_WORKERS"] = 0
+        with self.app.app_context():
+            hasher = PasswordHasher()
+            self.assertIsNone(hasher.get_executor())
+            hashed = hasher.hash("secret")
+            self.assertEqual(4, get_rounds(hashed))
+            self.assertTrue(hasher.check("secret", hashed))
+            self.assertFalse(hasher.check("wrong", hashed))
+
+    def test_overloaded(self):
+        with self.app.app_context():
+            hasher = PasswordHasher()
+            self.saturate(hasher)
+            with self.assertRaises(HashingOverloaded):
+                hasher.hash("secret")
+
+            hasher._slots.release()
+            self.assertTrue(hasher.check("secret", hasher.hash("secret")))
+
+    def test_overloaded_response(self):
+        self.register()
+        executor, slots, pid = password_hasher._executor, password_hasher._slots, password_hasher._pid
+        self.saturate(password_hasher)
+        try:
+            response = self.post('/api/auth/login/',
+                                 data={'email': self.email, 'password': self.password})
+            self.assertEqual(503, response.status_code)
+        finally:
+            password_hasher._slots.release()
+            password_hasher._executor, password_hasher._slots, password_hasher._pid = executor, slots, pid
+
+    def test_rehash_on_login(self):
+        with self.app.app_context():
+            db.session.add(User(email=self.email, password=self.password))
+            db.session.commit()
+
+        self.app.config["BCRYPT_LOG_ROUNDS"] = 5
+        self.assertEqual(200, self.login()[1])
+        with self.app.app_context():
+            user = User.query.filter_by(_email=self.email).one()
+            self.assertEqual(5, get_rounds(user.password_hash))
+            self.assertTrue(user.check_password(self.password))
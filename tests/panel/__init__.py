@@ -1 +1,3 @@
 from .media import MediaApiTestCase
+from .auth import PanelAuthTestCase
+from .registration import PanelRegistrationTestCase
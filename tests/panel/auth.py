@@ -0,0 +1,185 @@
+from functools import wraps
+
+from fardel.ext import db
+from fardel.core.auth.models import User, Group, Permission, sync_permissions
+from fardel.core.auth.cache import permission_sets, user_identities
+from fardel.core.panel.decorator import access_required, permission_required
+from ..base import BasePanelTestCase
+
+
+class PanelAuthTestCase(BasePanelTestCase):
+    def panel_login(self):
+        return self.client.post(
+            '/panel/login/', data={'email': self.email, 'password': self.password})
+
+    def permission_ids(self):
+        with self.app.app_context():
+            sync_permissions()
+            return [p.id for p in Permission.query.order_by(Permission.id)]
+
+    def test_access(self):
+        response = self.client.get('/panel/auth/users/list/')
+        self.assertEqual(401, response.status_code)
+
+        self.create_staff()
+        self.panel_login()
+        response = self.client.get('/panel/auth/users/list/')
+        self.assertEqual(403, response.status_code)
+
+        self.permission_ids()
+        self.set_staff_to_group(self.create_simple_group())
+        with self.app.app_context():
+            # Membership was changed outside the panel views
+            permission_sets.bump()
+        response = self.client.get('/panel/auth/users/list/')
+        self.assertEqual(200, response.status_code)
+        response = self.client.get('/panel/auth/users/create/')
+        self.assertEqual(403, response.status_code)
+
+        view = self.app.view_functions['panel.users_list']
+        self.assertTrue(view.decorators['staff_required'])
+        self.assertEqual(('can_get_users',), view.decorators['permission_required'])
+
+    def test_stacked_access(self):
+        def logged(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                return func(*args, **kwargs)
+            wrapper.logged = True
+            return wrapper
+
+        @access_required(staff=True)
+        @logged
+        @permission_required('can_get_users')
+        def view():
+            return 'ok'
+
+        @access_required(staff=True)
+        @permission_required('can_get_users')
+        def merged():
+            return 'ok'
+
+        # A foreign wrapper in between keeps its own layer
+        inner = view.__access_view__[1]
+        self.assertTrue(getattr(inner, 'logged', False))
+        self.assertEqual(('can_get_users',), inner.__wrapped__.access_policy.permissions)
+        self.assertEqual((), view.access_policy.permissions)
+
+        # Adjacent access decorators are still merged into one check
+        self.assertEqual(('can_get_users',), merged.access_policy.permissions)
+        self.assertFalse(hasattr(merged.__access_view__[1], 'access_policy'))
+
+    def test_edit_invalidates_identity(self):
+        self.create_admin()
+        self.panel_login()
+        with self.app.app_context():
+            user = User(email='edited@test.com', first_name='before', last_name='x')
+            db.session.add(user)
+            db.session.commit()
+            user_id = user.id
+            user_identities.by_id(user_id)
+
+        response = self.client.post('/panel/auth/users/edit/%d/' % user_id, data={
+            'email': 'edited@test.com', 'first_name': 'after', 'last_name': 'x'})
+        self.assertEqual(302, response.status_code)
+        with self.app.app_context():
+            self.assertEqual('after', user_identities.by_id(user_id).first_name)
+
+    def test_per_page_bounds(self):
+        self.create_admin()
+        self.panel_login()
+        with self.app.app_context():
+            db.session.add(User(email='listed@test.com'))
+            db.session.commit()
+        for per_page in ('0', '-5', '1000'):
+            response = self.client.get('/panel/auth/users/list/?per_page=%s' % per_page)
+            self.assertEqual(200, response.status_code)
+            self.assertIn(b'listed@test.com', response.data)
+
+    def test_groups(self):
+        self.create_admin()
+        self.panel_login()
+        permission_ids = self.permission_ids()
+
+        response = self.client.post('/panel/auth/group/create/', data={
+            'name': self.group_name, 'permissions': permission_ids + ['']})
+        self.assertEqual(302, response.status_code)
+        with self.app.app_context():
+            group = Group.query.filter_by(name=self.group_name).one()
+            group_id = group.id
+            self.assertEqual(permission_ids, sorted(p.id for p in group.permissions))
+
+        response = self.client.post('/panel/auth/group/edit/%d/' % group_id, data={
+            'name': self.group_name, 'permissions': permission_ids[:1] + [9999]})
+        self.assertEqual(302, response.status_code)
+        with self.app.app_context():
+            group = Group.query.get(group_id)
+            self.assertEqual(permission_ids[:1], [p.id for p in group.permissions])
+
+        response = self.client.get('/panel/auth/group/edit/%d/' % group_id)
+        self.assertEqual(200, response.status_code)
+
+    def test_users_create(self):
+        self.create_admin()
+        self.panel_login()
+        with self.app.app_context():
+            group = Group(name=self.group_name)
+            db.session.add(group)
+            db.session.commit()
+            group_id = group.id
+
+        response = self.client.post('/panel/auth/users/create/', data={
+            'email': 'staff@test.com', 'first_name': 'first', 'last_name': 'last',
+            'password': self.password, 'is_staff': 'on', 'group_ids': [group_id]})
+        self.assertEqual(302, response.status_code)
+        with self.app.app_context():
+            user = User.query.filter_by(_email='staff@test.com').one()
+            self.assertTrue(user.is_staff)
+            self.assertEqual([group_id], [g.id for g in user.groups])
+
+    def test_users_bulk(self):
+        self.create_admin()
+        self.panel_login()
+        with self.app.app_context():
+            group = Group(name=self.group_name)
+            users = [User(email='user%d@test.com' % i) for i in range(5)]
+            db.session.add(group)
+            db.session.add_all(users)
+            db.session.commit()
+            group_id = group.id
+            user_ids = [u.id for u in users]
+
+        response = self.client.post('/panel/auth/users/bulk/users/', data={
+            'action': 'confirm', 'user_ids': user_ids[:2]})
+        self.assertEqual(302, response.status_code)
+        response = self.client.post('/panel/auth/users/bulk/users/', data={
+            'action': 'add_to_group', 'group_id': group_id, 'select_all': '1'})
+        self.assertEqual(302, response.status_code)
+        response = self.client.post('/panel/auth/users/bulk/users/', data={
+            'action': 'add_to_group', 'group_id': group_id, 'user_ids': user_ids[:1]})
+        response = self.client.post('/panel/auth/users/bulk/users/', data={
+            'action': 'remove_from_group', 'group_id': group_id, 'user_ids': user_ids[:1]})
+        with self.app.app_context():
+            confirmed = User.query.filter(User.id.in_(user_ids), User.confirmed == True)
+            self.assertEqual(user_ids[:2], sorted(u.id for u in confirmed))
+            members = User.query.filter(User.groups.any(Group.id == group_id))
+            self.assertEqual(user_ids[1:], sorted(u.id for u in members))
+
+        response = self.client.get('/panel/auth/users/list/')
+        self.assertEqual(200, response.status_code)
+        self.assertIn(b'name="user_ids"', response.data)
+
+        response = self.client.post('/panel/auth/users/bulk/users/', data={'action': 'drop'})
+        self.assertEqual(400, response.status_code)
+
+    def clean(self):
+        with self.app.app_context():
+            for group in Group.query.filter_by(name=self.group_name):
+                group.permissions = []
+                db.session.delete(group)
+            db.session.execute(User.groups.property.secondary.delete())
+            User.query.delete()
+            db.session.commit()
+
+    def tearDown(self):
+        self.clean()
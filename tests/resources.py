@@ -0,0 +1,218 @@
+from flask import Blueprint
+from flask_babel import force_locale
+
+from fardel.ext import db
+from fardel.core.rest import create_api
+from fardel.core.base import PostBaseResource, DeleteBaseResource
+from fardel.core.utils import cache_get_key, make_cache_key
+from fardel.core.auth.models import User
+from fardel.core.serializers import dump_ids, dump_query, get_serializer
+from fardel.core.versions import model_versions
+from .base import BaseTestCase
+
+mod = Blueprint('test_resources', __name__, url_prefix='/api/test')
+api = create_api(mod)
+
+
+class UserListApi(PostBaseResource, DeleteBaseResource):
+    resource_class = User
+    list_fields = ('id', 'first_name')
+    max_limit = 5
+    max_batch_size = 4
+    required_to_create = ('email',)
+    optional_fields = ('first_name',)
+
+
+@cache_get_key(timeout=60, identity=False)
+class CachedUserApi(PostBaseResource):
+    resource_class = User
+    required_to_create = ('email',)
+
+
+class JsonUserApi(PostBaseResource):
+    resource_class = User
+    required_to_create = ('email',)
+
+    def validate(self, data):
+        return super().validate(self.get_json())
+
+
+api.add_resource(UserListApi, '/users/', '/users/<int:obj_id>/')
+api.add_resource(JsonUserApi, '/json/users/')
+api.add_resource(CachedUserApi, '/cached/users/')
+
+
+class GetBaseResourceTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app.register_blueprint(mod)
+        with self.app.app_context():
+            db.session.add_all([
+                User(email='user%d@test.com' % i, first_name='user%d' % i) for i in range(8)])
+            db.session.commit()
+
+    def tearDown(self):
+        with self.app.app_context():
+            User.query.delete()
+            db.session.commit()
+
+    def test_cursor(self):
+        response = self.get('/api/test/users/?limit=50', with_token=False)
+        data = self.get_json(response.data)
+        self.assertEqual(5, len(data['users']))
+        self.assertEqual(data['users'][-1]['id'], data['next_cursor'])
+
+        response = self.get('/api/test/users/?cursor=%d' % data['next_cursor'], with_token=False)
+        data = self.get_json(response.data)
+        self.assertEqual(3, len(data['users']))
+        self.assertIsNone(data['next_cursor'])
+
+    def test_fields(self):
+        response = self.get('/api/test/users/?fields=first_name&limit=2', with_token=False)
+        data = self.get_json(response.data)
+        self.assertEqual([{'first_name': 'user0'}, {'first_name': 'user1'}], data['users'])
+
+        response = self.get('/api/test/users/?fields=password_hash', with_token=False)
+        self.assertEqual(400, response.status_code)
+
+    def test_etag(self):
+        response = self.client.get('/api/test/users/')
+        etag = response.headers['ETag']
+        self.assertTrue(etag.startswith('W/'))
+
+        response = self.client.get('/api/test/users/', headers={'If-None-Match': etag})
+        self.assertEqual(304, response.status_code)
+        self.assertEqual(b'', response.data)
+
+        with self.app.app_context():
+            user = User.query.first()
+            user.first_name = 'changed'
+            db.session.commit()
+            user_id = user.id
+        response = self.client.get('/api/test/users/', headers={'If-None-Match': etag})
+        self.assertEqual(200, response.status_code)
+
+        response = self.client.get('/api/test/users/%d/' % user_id)
+        response = self.client.get('/api/test/users/%d/' % user_id,
+                                   headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(304, response.status_code)
+
+    def test_etag_outside_orm(self):
+        response = self.client.get('/api/test/users/')
+        etag = response.headers['ETag']
+        with self.app.app_context():
+            db.session.execute(User.__table__.update().values(first_name='raw'))
+            db.session.commit()
+        # Versions aren't shared with the simple backend, the response is hashed
+        response = self.client.get('/api/test/users/', headers={'If-None-Match': etag})
+        self.assertEqual(200, response.status_code)
+
+        self.app.config['MODEL_VERSIONS_SHARED'] = True
+        response = self.client.get('/api/test/users/')
+        etag = response.headers['ETag']
+        response = self.client.get('/api/test/users/', headers={'If-None-Match': etag})
+        self.assertEqual(304, response.status_code)
+        with self.app.app_context():
+            # Bumped by another process sharing the backend
+            model_versions.bump(User)
+        response = self.client.get('/api/test/users/', headers={'If-None-Match': etag})
+        self.assertEqual(200, response.status_code)
+
+    def test_cache_key(self):
+        with self.app.test_request_context('/api/test/users/?b=2&a=1&a=0'):
+            key = make_cache_key()
+        with self.app.test_request_context('/api/test/users/?a=1&a=0&b=2'):
+            self.assertEqual(key, make_cache_key())
+            self.assertNotEqual(key, make_cache_key(versions=['1']))
+        with self.app.test_request_context('/api/test/users/?a=1&a=0&b=2'), force_locale('fa'):
+            self.assertNotEqual(key, make_cache_key())
+        with self.app.test_request_context('/api/test/users/?a=1&a=0&b=3'):
+            self.assertNotEqual(key, make_cache_key())
+
+    def test_cache_get_key_opt_in(self):
+        @cache_get_key
+        class PlainApi(PostBaseResource):
+            resource_class = User
+
+        self.assertIs(make_cache_key, PlainApi.get.make_cache_key)
+        self.assertIs(PostBaseResource.get, PlainApi.get)
+
+    def test_cached_get(self):
+        response = self.get('/api/test/cached/users/?limit=100', with_token=False)
+        self.assertEqual(8, len(self.get_json(response.data)['users']))
+        with self.app.app_context():
+            User.query.filter_by(_email='user0@test.com').delete(synchronize_session=False)
+            db.session.commit()
+        response = self.get('/api/test/cached/users/?limit=100', with_token=False)
+        self.assertEqual(7, len(self.get_json(response.data)['users']))
+
+        response = self.post('/api/test/cached/users/', data={'email': 'new@test.com'}, with_token=False)
+        self.assertEqual(200, response.status_code)
+        response = self.get('/api/test/cached/users/?limit=100', with_token=False)
+        self.assertEqual(8, len(self.get_json(response.data)['users']))
+
+    def test_batch(self):
+        items = [{'email': 'a@test.com'}, {'first_name': 'x'}, {'email': 'user1@test.com'}, {'email': 'b@test.com'}]
+        response = self.post('/api/test/users/', data=items, with_token=False)
+        results = self.get_json(response.data)['results']
+        self.assertEqual([200, 422, 422, 200], [r['status'] for r in results])
+        self.assertEqual('a@test.com', results[0]['user']['email'])
+
+        response = self.post('/api/test/users/', data=items + items, with_token=False)
+        self.assertEqual(413, response.status_code)
+
+        ids = [results[0]['user']['id'], results[3]['user']['id'], 999999, 'x']
+        response = self.delete('/api/test/users/', data=ids, with_token=False)
+        results = self.get_json(response.data)['results']
+        self.assertEqual([200, 200, 404, 422], [r['status'] for r in results])
+        with self.app.app_context():
+            self.assertEqual(8, User.query.count())
+
+    def test_batch_invalid_value(self):
+        items = [{'email': 'c@test.com'}, {'email': 'd@test.com', 'first_name': {'x': 1}}]
+        response = self.post('/api/test/users/', data=items, with_token=False)
+        self.assertEqual(200, response.status_code)
+        results = self.get_json(response.data)['results']
+        self.assertEqual([200, 422], [r['status'] for r in results])
+        with self.app.app_context():
+            self.assertEqual(1, User.query.filter_by(_email='c@test.com').count())
+            self.assertEqual(0, User.query.filter_by(_email='d@test.com').count())
+
+    def test_trailing_data(self):
+        for body in ('[{"email": "e@test.com"}] garbage', '[] ]', '[{"email": "e@test.com"}] \n'):
+            response = self.client.post('/api/test/users/', data=body, content_type='application/json')
+            self.assertEqual(200 if body.endswith('\n') else 400, response.status_code, body)
+
+    def test_get_json_after_read_body(self):
+        response = self.post('/api/test/json/users/', data={'email': 'json@test.com'}, with_token=False)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('json@test.com', self.get_json(response.data)['user']['email'])
+
+    def test_serializer(self):
+        response = self.get('/api/test/users/?limit=2', with_token=False)
+        users = self.get_json(response.data)['users']
+        with self.app.app_context():
+            self.assertEqual([u.dict() for u in User.query.order_by(User.id).limit(2)], users)
+            self.assertEqual({'id', 'first_name', 'last_name', 'email', 'is_confirmed'}, set(users[0]))
+            self.assertEqual(users, dump_ids(User, [users[0]['id'], users[1]['id']]))
+            self.assertEqual(users[::-1], dump_ids(User, [users[1]['id'], users[0]['id']]))
+
+    def test_serializer_overridden_dict(self):
+        class Model(object):
+            serializer = object()
+
+            def dict(self):
+                return {'plain': True}
+
+        class Custom(Model):
+            def dict(self):
+                return {'custom': True}
+
+        class Child(Custom):
+            serializer = object()
+
+        self.assertIs(Model.serializer, get_serializer(Model))
+        self.assertIsNone(get_serializer(Custom))
+        self.assertIs(Child.serializer, get_serializer(Child))
+        self.assertIsNone(get_serializer(object))
+        self.assertEqual([{'custom': True}], dump_query(Custom, [Custom()]))
@@ -0,0 +1,200 @@
+import os
+import time
+import shutil
+import tempfile
+
+from fardel import core
+from fardel.ext import db
+from fardel.core import indexer, fulltext
+from fardel.core.searchcache import search_cache
+from fardel.core.auth.models import User
+from .base import BaseTestCase
+
+
+class SlowQuery(object):
+    def __init__(self, delay=0, error=None):
+        self.delay = delay
+        self.error = error
+        self.calls = 0
+
+    def search(self, search_string):
+        if self.error:
+            raise self.error
+        return self
+
+    def paginate(self, page, per_page, error_out):
+        self.calls += 1
+        time.sleep(self.delay)
+        return self
+
+    items = []
+
+
+class Slow(object):
+    __tablename__ = "slow"
+    query = SlowQuery(delay=1)
+
+
+class Broken(object):
+    __tablename__ = "broken"
+    query = SlowQuery(error=RuntimeError("search failed"))
+
+
+class IndexSearchTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.index_dir = tempfile.mkdtemp()
+        self.app.config["SEARCH_BACKEND"] = "index"
+        self.app.config["SEARCH_INDEX_DIR"] = self.index_dir
+        User.search_fields = {"first_name": 2, "last_name": 1}
+        core.models.append(User)
+        indexer.search_index._indexes.clear()
+
+    def tearDown(self):
+        core.models.remove(User)
+        del User.search_fields
+        indexer.search_index._indexes.clear()
+        shutil.rmtree(self.index_dir)
+        with self.app.app_context():
+            User.query.delete()
+            db.session.commit()
+
+    def search(self, q):
+        response = self.get('/api/search/?q=%s' % q, with_token=False)
+        return [u['email'] for u in self.get_json(response.data)['users']]
+
+    def test_index(self):
+        with self.app.app_context():
+            db.session.add_all([
+                User(email='a@test.com', first_name='Ada', last_name='Lovelace'),
+                User(email='b@test.com', first_name='Grace', last_name='Ada Hopper'),
+            ])
+            db.session.commit()
+            indexer.reindex()
+
+            db.session.add(User(email='c@test.com', first_name='Alan', last_name='Turing'))
+            db.session.commit()
+
+        self.assertEqual(['a@test.com', 'b@test.com'], self.search('ada'))
+        self.assertEqual(['c@test.com'], self.search('turing'))
+
+        with self.app.app_context():
+            User.query.filter_by(_email='a@test.com').one().first_name = 'Augusta'
+            db.session.delete(User.query.filter_by(_email='c@test.com').one())
+            db.session.commit()
+        self.assertEqual(['b@test.com'], self.search('ada'))
+        self.assertEqual([], self.search('turing'))
+
+        with self.app.app_context():
+            indexer.reindex()
+        self.assertEqual(['a@test.com'], self.search('augusta'))
+        self.assertEqual(['b@test.com'], self.search('ada'))
+
+    def test_deadline(self):
+        self.app.config["SEARCH_TIMEOUT"] = 0.3
+        with self.app.app_context():
+            db.session.add(User(email='a@test.com', first_name='Ada'))
+            db.session.commit()
+        core.models.extend([Slow, Broken])
+        try:
+            started = time.monotonic()
+            response = self.get('/api/search/?q=ada', with_token=False)
+            elapsed = time.monotonic() - started
+        finally:
+            core.models.remove(Slow)
+            core.models.remove(Broken)
+
+        data = self.get_json(response.data)
+        self.assertEqual(200, response.status_code)
+        self.assertLess(elapsed, 1)
+        self.assertEqual(['a@test.com'], [u['email'] for u in data['users']])
+        self.assertNotIn('slows', data)
+        self.assertEqual(['slows'], data['timed_out'])
+        self.assertEqual(['brokens'], data['failed'])
+
+    def test_still_running(self):
+        self.app.config["SEARCH_TIMEOUT"] = 0.3
+        # A search left running by another test would be skipped
+        if Slow in core._running:
+            core._running[Slow].result()
+        core.models.append(Slow)
+        calls = Slow.query.calls
+        try:
+            first = self.get_json(self.get('/api/search/?q=ada', with_token=False).data)
+            started = time.monotonic()
+            second = self.get_json(self.get('/api/search/?q=grace', with_token=False).data)
+            elapsed = time.monotonic() - started
+            running = core._running[Slow]
+        finally:
+            core.models.remove(Slow)
+
+        self.assertEqual(['slows'], first['timed_out'])
+        self.assertEqual(['slows'], second['timed_out'])
+        self.assertLess(elapsed, 0.3)
+        self.assertEqual(calls + 1, Slow.query.calls)
+        running.result()
+
+    def test_compaction(self):
+        self.app.config["SEARCH_INDEX_COMPACT_BYTES"] = 1
+        with self.app.app_context():
+            db.session.add(User(email='a@test.com', first_name='Ada'))
+            db.session.commit()
+            index = indexer.search_index.get(User)
+            index.compactor.join()
+
+            self.assertEqual(0, os.path.getsize(index.log_path))
+            self.assertEqual(['a@test.com'], self.search('ada'))
+            self.assertEqual({}, index.overlay)
+            self.assertFalse(index.compact(1))
+
+    def use_fulltext(self):
+        self.app.config["SEARCH_BACKEND"] = "fulltext"
+        with self.app.app_context():
+            # Other databases search with the LIKE fallback
+            if db.engine.dialect.name == "postgresql":
+                fulltext.add_search_vector(User)
+                db.session.commit()
+                self.addCleanup(self.drop_search_vector)
+
+    def drop_search_vector(self):
+        with self.app.app_context():
+            fulltext.drop_search_vector(User)
+            db.session.commit()
+
+    def test_fulltext(self):
+        self.use_fulltext()
+        with self.app.app_context():
+            db.session.add_all([
+                User(email='a@test.com', first_name='Ada', last_name='Lovelace'),
+                User(email='b@test.com', first_name='Grace', last_name='Ada Hopper'),
+            ])
+            db.session.commit()
+        self.assertEqual(['a@test.com', 'b@test.com'], self.search('ada'))
+        self.assertEqual(['b@test.com'], self.search('hopper%20ada'))
+
+        alter, index = fulltext.search_vector_ddl(User)
+        self.assertIn("setweight(to_tsvector('simple'::regconfig, coalesce(\"first_name\"::text, '')), 'A')", alter)
+        self.assertIn("'B')", alter)
+        self.assertIn("USING GIN (search_vector)", index)
+
+        self.assertFalse(fulltext.include_object(None, "search_vector", "column", True, None))
+        self.assertFalse(fulltext.include_object(None, "ix_auth_users_search_vector", "index", True, None))
+        self.assertTrue(fulltext.include_object(None, "first_name", "column", True, None))
+
+    def test_cache(self):
+        self.app.config["SEARCH_MAX_PER_PAGE"] = 2
+        with self.app.app_context():
+            db.session.add_all([
+                User(email='user%d@test.com' % i, first_name='Ada') for i in range(3)])
+            db.session.commit()
+
+        hits = search_cache.hits
+        self.assertEqual(['user0@test.com', 'user1@test.com'], self.search('ada&per_page=10'))
+        self.assertEqual(2, len(self.search('%20ADA%20&per_page=10')))
+        self.assertEqual(hits + 1, search_cache.hits)
+
+        with self.app.app_context():
+            User.query.filter_by(_email='user0@test.com').one().first_name = 'Grace'
+            db.session.commit()
+        self.assertEqual(['user1@test.com', 'user2@test.com'], self.search('ada&per_page=10'))
+        self.assertEqual(hits + 1, search_cache.hits)